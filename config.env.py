@@ -30,6 +30,15 @@ SQLALCHEMY_TRACK_MODIFICATIONS = False
 # LDAP config
 LDAP_BIND_DN = environ.get("PACKET_LDAP_BIND_DN", None)
 LDAP_BIND_PASS = environ.get("PACKET_LDAP_BIND_PASS", None)
+# Seconds to answer group membership questions from an in memory snapshot of the directory before reloading it, 0 to
+# query LDAP every time instead
+LDAP_SNAPSHOT_TTL = int(environ.get("PACKET_LDAP_SNAPSHOT_TTL", "300"))
+# How many members to cache lookups of and for how many seconds, lookups of missing members are cached for less time
+LDAP_MEMBER_CACHE_SIZE = int(environ.get("PACKET_LDAP_MEMBER_CACHE_SIZE", "1024"))
+LDAP_MEMBER_CACHE_TTL = int(environ.get("PACKET_LDAP_MEMBER_CACHE_TTL", "300"))
+LDAP_MEMBER_MISS_TTL = int(environ.get("PACKET_LDAP_MEMBER_MISS_TTL", "60"))
+# How many seconds a logged in user's groups are reused across requests
+IDENTITY_CACHE_TTL = int(environ.get("PACKET_IDENTITY_CACHE_TTL", "60"))
 LDAP_MOCK_MEMBERS = [
         {'uid':'evals', 'groups': ['eboard', 'eboard-evaluations', 'active']},
         {'uid':'imps-3da', 'groups': ['eboard', 'eboard-imps', '3da', 'active']},
@@ -44,6 +53,16 @@ LDAP_MOCK_MEMBERS = [
         {'uid':'alum', 'groups': ['member']},
     ]
 
+# Rendered page cache config, a packet's tables are re-rendered whenever it changes
+PACKET_FRAGMENT_CACHE_SIZE = int(environ.get("PACKET_FRAGMENT_CACHE_SIZE", "256"))
+PACKET_FRAGMENT_CACHE_TTL = int(environ.get("PACKET_FRAGMENT_CACHE_TTL", "600"))
+
+# Live signature streams, each open page holds a connection and a server thread so cap how many a process serves,
+# keeping it below gunicorn's --threads so there are always threads left for other requests.
+# Streams are closed after STREAM_MAX_SECONDS and the browser reconnects, keep it below gunicorn's --timeout
+STREAM_MAX_CONNECTIONS = int(environ.get("PACKET_STREAM_MAX_CONNECTIONS", "50"))
+STREAM_MAX_SECONDS = int(environ.get("PACKET_STREAM_MAX_SECONDS", "540"))
+
 # Mail Config
 MAIL_PROD = strtobool(environ.get("PACKET_MAIL_PROD", "False"))
 MAIL_SERVER = environ.get("PACKET_MAIL_SERVER", "thoth.csh.rit.edu")
@@ -57,6 +76,19 @@ ONESIGNAL_CSH_APP_AUTH_KEY = environ.get("PACKET_ONESIGNAL_CSH_APP_AUTH_KEY", No
 ONESIGNAL_CSH_APP_ID = environ.get("PACKET_ONESIGNAL_CSH_APP_ID", "6eff123a-0852-4027-804e-723044756f00")
 ONESIGNAL_INTRO_APP_AUTH_KEY = environ.get("PACKET_ONESIGNAL_INTRO_APP_AUTH_KEY", None)
 ONESIGNAL_INTRO_APP_ID = environ.get("PACKET_ONESIGNAL_INTRO_APP_ID", "6eff123a-0852-4027-804e-723044756f00")
+ONESIGNAL_MAX_CONCURRENCY = int(environ.get("PACKET_ONESIGNAL_MAX_CONCURRENCY", "4"))
+
+# Seconds to collect signatures into a single "signed your packet" notification, keyed by the realm they're signed in
+SIGNED_NOTIFICATION_WINDOW = {
+    "csh": int(environ.get("PACKET_CSH_SIGNED_NOTIFICATION_WINDOW", "60")),
+    "intro": int(environ.get("PACKET_INTRO_SIGNED_NOTIFICATION_WINDOW", "60")),
+}
+
+# Freshman images are resolved from Gravatar in the background and rechecked after this many hours
+AVATAR_TTL_HOURS = int(environ.get("PACKET_AVATAR_TTL_HOURS", "72"))
+AVATAR_RESOLVE_CONCURRENCY = int(environ.get("PACKET_AVATAR_RESOLVE_CONCURRENCY", "8"))
+# Where the /avatar/ endpoint keeps its resized copies of member and freshman images
+AVATAR_CACHE_DIR = environ.get("PACKET_AVATAR_CACHE_DIR", path.join(getcwd(), "avatar_cache"))
 
 # Sentry Config
 SENTRY_DSN = environ.get("PACKET_SENTRY_DSN", "")
@@ -64,6 +96,11 @@ SENTRY_DSN = environ.get("PACKET_SENTRY_DSN", "")
 # Slack URL for pushing to #general
 SLACK_WEBHOOK_URL = environ.get("PACKET_SLACK_URL", None)
 
+# Background job config, failed jobs are retried after JOB_RETRY_SECONDS * 2^attempts capped at JOB_RETRY_MAX_SECONDS
+JOB_MAX_ATTEMPTS = int(environ.get("PACKET_JOB_MAX_ATTEMPTS", "8"))
+JOB_RETRY_SECONDS = int(environ.get("PACKET_JOB_RETRY_SECONDS", "30"))
+JOB_RETRY_MAX_SECONDS = int(environ.get("PACKET_JOB_RETRY_MAX_SECONDS", "3600"))
+
 # Packet Config
 PACKET_UPPER = environ.get("PACKET_UPPER", "packet.csh.rit.edu")
 PACKET_INTRO = environ.get("PACKET_INTRO", "freshmen-packet.csh.rit.edu")
@@ -0,0 +1,42 @@
+"""Signature counters
+
+Revision ID: 2c1e6a9d4f8b
+Revises: a243fac8a399
+Create Date: 2026-10-18 12:04:31.518204
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '2c1e6a9d4f8b'
+down_revision = 'a243fac8a399'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('packet', sa.Column('upper_signed', sa.Integer(), nullable=False, server_default='0'))
+    op.add_column('packet', sa.Column('fresh_signed', sa.Integer(), nullable=False, server_default='0'))
+    op.add_column('packet', sa.Column('misc_signed', sa.Integer(), nullable=False, server_default='0'))
+    op.add_column('packet', sa.Column('upper_required', sa.Integer(), nullable=False, server_default='0'))
+    op.add_column('packet', sa.Column('fresh_required', sa.Integer(), nullable=False, server_default='0'))
+
+    # Backfill the counters for existing packets
+    op.execute('''
+        UPDATE packet SET
+            upper_signed = (SELECT count(*) FROM signature_upper s WHERE s.packet_id = packet.id AND s.signed),
+            fresh_signed = (SELECT count(*) FROM signature_fresh s WHERE s.packet_id = packet.id AND s.signed),
+            misc_signed = (SELECT count(*) FROM signature_misc s WHERE s.packet_id = packet.id),
+            upper_required = (SELECT count(*) FROM signature_upper s WHERE s.packet_id = packet.id),
+            fresh_required = (SELECT count(*) FROM signature_fresh s WHERE s.packet_id = packet.id)
+    ''')
+
+
+def downgrade():
+    op.drop_column('packet', 'fresh_required')
+    op.drop_column('packet', 'upper_required')
+    op.drop_column('packet', 'misc_signed')
+    op.drop_column('packet', 'fresh_signed')
+    op.drop_column('packet', 'upper_signed')
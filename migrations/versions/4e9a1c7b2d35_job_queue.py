@@ -0,0 +1,35 @@
+"""Job queue
+
+Revision ID: 4e9a1c7b2d35
+Revises: 7d3f0b52a6c1
+Create Date: 2026-10-18 16:12:47.903311
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '4e9a1c7b2d35'
+down_revision = '7d3f0b52a6c1'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('job',
+    sa.Column('id', sa.Integer(), autoincrement=True, nullable=False),
+    sa.Column('kind', sa.String(length=64), nullable=False),
+    sa.Column('payload', sa.JSON(), nullable=False),
+    sa.Column('attempts', sa.Integer(), server_default='0', nullable=False),
+    sa.Column('run_after', sa.DateTime(), nullable=False),
+    sa.Column('created', sa.DateTime(), nullable=False),
+    sa.Column('last_error', sa.Text(), nullable=True),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index(op.f('ix_job_run_after'), 'job', ['run_after'], unique=False)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_job_run_after'), table_name='job')
+    op.drop_table('job')
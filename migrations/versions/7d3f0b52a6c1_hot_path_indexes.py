@@ -0,0 +1,44 @@
+"""Hot path indexes
+
+Revision ID: 7d3f0b52a6c1
+Revises: 2c1e6a9d4f8b
+Create Date: 2026-10-18 14:36:12.270193
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '7d3f0b52a6c1'
+down_revision = '2c1e6a9d4f8b'
+branch_labels = None
+depends_on = None
+
+
+# (name, table, columns, partial index condition)
+indexes = [
+    ('ix_signature_upper_member', 'signature_upper', ['member'], None),
+    ('ix_signature_upper_signed', 'signature_upper', ['packet_id'], 'signed'),
+    ('ix_signature_fresh_freshman_username', 'signature_fresh', ['freshman_username'], None),
+    ('ix_signature_fresh_signed', 'signature_fresh', ['packet_id'], 'signed'),
+    ('ix_signature_misc_member', 'signature_misc', ['member'], None),
+    ('ix_notification_subscriptions_member', 'notification_subscriptions', ['member'], None),
+    ('ix_notification_subscriptions_freshman_username', 'notification_subscriptions', ['freshman_username'], None),
+    ('ix_packet_freshman_username', 'packet', ['freshman_username'], None),
+    ('ix_packet_end_start', 'packet', ['end', 'start'], None),
+]
+
+
+def upgrade():
+    # CREATE INDEX CONCURRENTLY can't run inside a transaction, but it doesn't block signing while the indexes build
+    with op.get_context().autocommit_block():
+        for name, table, columns, where in indexes:
+            op.create_index(name, table, columns, postgresql_concurrently=True,
+                            postgresql_where=sa.text(where) if where else None)
+
+
+def downgrade():
+    with op.get_context().autocommit_block():
+        for name, table, _, _ in reversed(indexes):
+            op.drop_index(name, table_name=table, postgresql_concurrently=True)
@@ -0,0 +1,31 @@
+"""Signed notification batches
+
+Revision ID: 9b5d2e8f1a47
+Revises: 4e9a1c7b2d35
+Create Date: 2026-10-18 17:03:19.446025
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision = '9b5d2e8f1a47'
+down_revision = '4e9a1c7b2d35'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('signed_notification_batch',
+    sa.Column('packet_id', sa.Integer(), nullable=False),
+    sa.Column('signers', postgresql.ARRAY(sa.String(length=36)), nullable=False),
+    sa.Column('created', sa.DateTime(), nullable=False),
+    sa.ForeignKeyConstraint(['packet_id'], ['packet.id'], ),
+    sa.PrimaryKeyConstraint('packet_id')
+    )
+
+
+def downgrade():
+    op.drop_table('signed_notification_batch')
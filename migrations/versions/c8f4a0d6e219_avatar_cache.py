@@ -0,0 +1,29 @@
+"""Avatar cache
+
+Revision ID: c8f4a0d6e219
+Revises: 9b5d2e8f1a47
+Create Date: 2026-10-18 18:41:05.127733
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c8f4a0d6e219'
+down_revision = '9b5d2e8f1a47'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('avatar',
+    sa.Column('username', sa.String(length=36), nullable=False),
+    sa.Column('url', sa.String(length=256), nullable=False),
+    sa.Column('checked', sa.DateTime(), nullable=False),
+    sa.PrimaryKeyConstraint('username')
+    )
+
+
+def downgrade():
+    op.drop_table('avatar')
@@ -0,0 +1,24 @@
+"""Packet revision
+
+Revision ID: d5e7a9c1b3f2
+Revises: c8f4a0d6e219
+Create Date: 2026-10-18 21:12:44.318402
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd5e7a9c1b3f2'
+down_revision = 'c8f4a0d6e219'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('packet', sa.Column('revision', sa.Integer(), nullable=False, server_default='0'))
+
+
+def downgrade():
+    op.drop_column('packet', 'revision')
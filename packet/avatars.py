@@ -0,0 +1,196 @@
+"""
+Resolves freshmen's Gravatar images in the background and keeps them in the DB so rendering a page never waits on
+gravatar.com
+
+Each process keeps a copy of the resolved URLs that it reloads from the DB every RELOAD_INTERVAL. Anything missing or
+older than AVATAR_TTL_HOURS is handed to a small thread pool and shows the default image until it's resolved.
+
+The /avatar/ endpoint serves small resized copies of the images out of AVATAR_CACHE_DIR so list pages don't make the
+browser download hundreds of full size cross-origin images. Copies are made in the same thread pool, the default image
+is served until they're ready.
+"""
+import hashlib
+import io
+import os
+import re
+import tempfile
+import threading
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from typing import Iterable, Optional
+
+import requests
+from PIL import Image
+
+from packet import app, db
+from packet.models import Avatar
+
+DEFAULT_RIT_IMAGE = 'https://www.gravatar.com/avatar/freshmen?d=mp&f=y'
+
+# How often each process picks up the URLs resolved by other processes
+RELOAD_INTERVAL = timedelta(minutes=1)
+
+# Lives as long as the process so it's never shut down
+_resolve_pool = ThreadPoolExecutor(  # pylint: disable=consider-using-with
+    max_workers=app.config['AVATAR_RESOLVE_CONCURRENCY'], thread_name_prefix='avatar')
+_lock = threading.Lock()
+_urls: dict[str, tuple[str, datetime]] = dict()
+_pending: set[str] = set()
+_loaded: Optional[datetime] = None
+
+
+def resolve_rit_image(username: str) -> str:
+    """
+    Probes Gravatar for the freshman's RIT addresses, this blocks on the network so only call it in the background
+    Raises if Gravatar couldn't be reached so a network blip isn't cached as a missing image
+    """
+    for addr in [username + '@rit.edu', username + '@g.rit.edu']:
+        url = 'https://gravatar.com/avatar/' + hashlib.md5(addr.encode('utf8')).hexdigest() + '.jpg?d=404&s=250'
+        try:
+            with urllib.request.urlopen(url, timeout=5) as gravatar:
+                if gravatar.getcode() == 200:
+                    return url
+        except urllib.error.HTTPError as e:
+            if e.code != 404:
+                raise
+    return DEFAULT_RIT_IMAGE
+
+
+def _refresh(username: str) -> None:
+    try:
+        url = resolve_rit_image(username)
+        with app.app_context():
+            Avatar.store(username, url)
+            db.session.commit()
+        with _lock:
+            _urls[username] = (url, datetime.now())
+    except Exception as e:  # pylint: disable=broad-except
+        app.logger.warn('Failed to resolve the image for {}: {!r}'.format(username, e))
+    finally:
+        with _lock:
+            _pending.discard(username)
+
+
+def _schedule(username: str) -> None:
+    with _lock:
+        if username in _pending:
+            return
+        _pending.add(username)
+    _resolve_pool.submit(_refresh, username)
+
+
+def _reload() -> None:
+    global _loaded  # pylint: disable=global-statement
+    now = datetime.now()
+    if _loaded is not None and now - _loaded < RELOAD_INTERVAL:
+        return
+    rows = db.session.query(Avatar.username, Avatar.url, Avatar.checked).all()
+    with _lock:
+        _urls.update({username: (url, checked) for username, url, checked in rows})
+        _loaded = now
+
+
+def _is_stale(checked: datetime) -> bool:
+    return checked < datetime.now() - timedelta(hours=app.config['AVATAR_TTL_HOURS'])
+
+
+def get_rit_image(username: str) -> str:
+    """
+    :return: The freshman's last resolved image, or the default image while it's being resolved
+    """
+    if not username:
+        return DEFAULT_RIT_IMAGE
+    _reload()
+    cached = _urls.get(username)
+    if cached is None or _is_stale(cached[1]):
+        _schedule(username)
+    return cached[0] if cached is not None else DEFAULT_RIT_IMAGE
+
+
+def refresh_rit_images(usernames: Iterable[str], force: bool = False) -> int:
+    """
+    Resolves the images of the given freshmen concurrently and waits for them to finish
+    :param force: Resolve every image, not just the missing and stale ones
+    :return: The number of images resolved
+    """
+    checked = dict(db.session.query(Avatar.username, Avatar.checked))
+    usernames = [username for username in usernames
+                 if force or username not in checked or _is_stale(checked[username])]
+    list(_resolve_pool.map(_refresh, usernames))
+    return len(usernames)
+
+
+# The sizes thumbnails are made in, the smallest is used on list pages and the largest when a picture is zoomed in on
+THUMBNAIL_SIZES = (50, 200)
+
+_valid_username = re.compile(r'^[A-Za-z0-9._-]+$')
+
+# The thumbnails being fetched, so a burst of requests for the same missing image only fetches it once
+_fetching: set[str] = set()
+
+
+def source_url(kind: str, username: str) -> Optional[str]:
+    """
+    :param kind: 'csh' for a member's profile picture or 'rit' for a freshman's Gravatar
+    :return: Where to fetch the full size image from, or None if there isn't one (yet)
+    """
+    if kind == 'csh':
+        return 'https://profiles.csh.rit.edu/image/' + username
+    if kind == 'rit':
+        url = get_rit_image(username)
+        return url if url != DEFAULT_RIT_IMAGE else None
+    return None
+
+
+def _fetch_thumbnail(url: str, path: str, size: int) -> None:
+    try:
+        response = requests.get(url, timeout=5)
+        response.raise_for_status()
+        image = Image.open(io.BytesIO(response.content))
+        image.thumbnail((size, size))
+
+        # Write to a temporary file first so a concurrent request never serves a half written image
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with tempfile.NamedTemporaryFile(dir=os.path.dirname(path), suffix='.tmp', delete=False) as tmp:
+            tmp_path = tmp.name
+        try:
+            image.convert('RGB').save(tmp_path, 'JPEG', quality=85)
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+    except Exception as e:  # pylint: disable=broad-except
+        # Keep serving the stale copy if there is one
+        app.logger.warn('Failed to fetch the image {} for {}: {!r}'.format(url, path, e))
+    finally:
+        with _lock:
+            _fetching.discard(path)
+
+
+def _schedule_thumbnail(url: str, path: str, size: int) -> None:
+    with _lock:
+        if path in _fetching:
+            return
+        _fetching.add(path)
+    _resolve_pool.submit(_fetch_thumbnail, url, path, size)
+
+
+def thumbnail_path(kind: str, username: str, size: int) -> Optional[str]:
+    """
+    Fetches and resizes the image in the background the first time it's asked for and again once it's older than
+    AVATAR_TTL_HOURS, the stale copy is served until the new one is ready
+    :return: The path of the cached thumbnail, or None if there's no image for the user or it hasn't been fetched yet
+    """
+    if size not in THUMBNAIL_SIZES or not _valid_username.match(username):
+        return None
+    url = source_url(kind, username)
+    if url is None:
+        return None
+
+    path = os.path.join(app.config['AVATAR_CACHE_DIR'], kind, str(size), username + '.jpg')
+    exists = os.path.exists(path)
+    if not exists or _is_stale(datetime.fromtimestamp(os.path.getmtime(path))):
+        _schedule_thumbnail(url, path, size)
+    return path if exists else None
@@ -0,0 +1,133 @@
+"""
+An in memory cache whose entries expire, for lookups where lru_cache would keep serving stale results until a restart
+"""
+import threading
+import time
+from collections import OrderedDict
+from functools import update_wrapper
+from typing import Any, Callable, Hashable, NamedTuple
+
+
+class CacheInfo(NamedTuple):
+    hits: int
+    misses: int
+    expired: int
+    currsize: int
+    maxsize: int
+
+
+class _Entry(NamedTuple):
+    expires: float
+    raised: bool
+    value: Any
+
+
+class TTLCache:
+    """
+    A thread safe LRU cache around func where results expire after ttl seconds
+    Calls that raise one of miss_exceptions are cached for miss_ttl seconds and raise again until they expire, so a
+    lookup of something that doesn't exist isn't retried on every call
+    """
+
+    def __init__(self, func: Callable, maxsize: int, ttl: float, miss_ttl: float = 0,
+                 miss_exceptions: tuple[type[Exception], ...] = ()) -> None:
+        update_wrapper(self, func)
+        self.func = func
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.miss_ttl = miss_ttl
+        self.miss_exceptions = miss_exceptions
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self._entries: OrderedDict[Hashable, _Entry] = OrderedDict()
+        self._lock = threading.Lock()
+
+
+    def __call__(self, *args: Hashable) -> Any:
+        with self._lock:
+            entry = self._entries.get(args)
+            if entry is not None and entry.expires <= time.monotonic():
+                del self._entries[args]
+                self.expired += 1
+                entry = None
+            if entry is not None:
+                self.hits += 1
+                self._entries.move_to_end(args)
+            else:
+                self.misses += 1
+
+        if entry is not None:
+            if entry.raised:
+                raise entry.value.with_traceback(None)
+            return entry.value
+
+        try:
+            value = self.func(*args)
+        except self.miss_exceptions as e:
+            if self.miss_ttl:
+                self._store(args, _Entry(time.monotonic() + self.miss_ttl, True, e))
+            raise
+        self._store(args, _Entry(time.monotonic() + self.ttl, False, value))
+        return value
+
+
+    def _store(self, key: Hashable, entry: _Entry) -> None:
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            self._evict()
+
+
+    def _evict(self) -> None:
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+
+    def is_cached(self, *args: Hashable) -> bool:
+        """
+        :return: Whether calling with the given arguments would be answered from the cache
+        """
+        with self._lock:
+            entry = self._entries.get(args)
+            return entry is not None and entry.expires > time.monotonic()
+
+
+    def put(self, value: Any, *args: Hashable) -> None:
+        """
+        Caches value as the result for the given arguments, for results that were looked up in bulk
+        """
+        self._store(args, _Entry(time.monotonic() + self.ttl, False, value))
+
+
+    def resize(self, maxsize: int) -> None:
+        with self._lock:
+            self.maxsize = maxsize
+            self._evict()
+
+
+    def invalidate(self, *args: Hashable) -> None:
+        """
+        Drops the cached result for the given arguments
+        """
+        with self._lock:
+            self._entries.pop(args, None)
+
+
+    def cache_clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+
+    def cache_info(self) -> CacheInfo:
+        return CacheInfo(self.hits, self.misses, self.expired, len(self._entries), self.maxsize)
+
+
+def ttl_cache(maxsize: int, ttl: float, miss_ttl: float = 0,
+              miss_exceptions: tuple[type[Exception], ...] = ()) -> Callable[[Callable], TTLCache]:
+    """
+    Decorator form of TTLCache
+    """
+    def decorator(func: Callable) -> TTLCache:
+        return TTLCache(func, maxsize, ttl, miss_ttl, miss_exceptions)
+    return decorator
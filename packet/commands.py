@@ -2,15 +2,21 @@
 Defines command-line utilities for use with packet
 """
 
+import smtplib
 import sys
 
 from secrets import token_hex
-from datetime import datetime, time, date
+from datetime import datetime, time, date, timedelta
+from typing import Any, Optional, cast
 import csv
 import click
+from flask_mail import Connection, Mail
+from sqlalchemy import event
+from sqlalchemy.orm import joinedload
 
-from . import app, db
-from .models import Packet, FreshSignature, UpperSignature, MiscSignature
+from . import app, avatars, db, events, jobs, stats
+from .mail import render_start_packet_mail, send_batch
+from .models import Freshman, Packet, FreshSignature, UpperSignature, MiscSignature, NotificationSubscription
 from .utils import sync_freshman, sync_with_ldap
 
 
@@ -62,9 +68,21 @@ def sync_freshmen(freshmen_csv: str) -> None:
     freshmen_in_csv = parse_csv(freshmen_csv)
 
     print('Syncing contents with the DB...')
-    sync_freshman(freshmen_in_csv)
+    summary = sync_freshman(freshmen_in_csv)
+    print('Changed {freshmen_changed} freshmen, moved {freshmen_offfloor} off floor, and created '
+          '{signatures_created} signatures'.format(**summary))
     print('Done!')
 
+@app.cli.command('refresh-avatars')
+@click.option('--force', is_flag=True, default=False, help='Recheck every image, not just missing and stale ones.')
+def refresh_avatars(force: bool) -> None:
+    """
+    Resolves the Gravatar images of every freshman so pages don't show the default image while they're looked up.
+    """
+    usernames = [username for username, in db.session.query(Freshman.rit_username)]
+    print('Resolved {} images'.format(avatars.refresh_rit_images(usernames, force)))
+
+
 # TODO: this needs fixed with a proper datetime
 # @app.cli.command('create-packets')
 # @click.argument('freshmen_csv')
@@ -88,7 +106,9 @@ def ldap_sync() -> None:
     """
     Updates the upper and misc sigs in the DB to match ldap.
     """
-    sync_with_ldap()
+    summary = sync_with_ldap()
+    print('Updated roles on {roles_updated} signatures, demoted {demoted}, promoted {promoted}, and created '
+          '{created}'.format(**summary))
     print('Done!')
 
 
@@ -114,7 +134,7 @@ def fetch_results(file_path: str, use_csv: bool, date_str: str) -> None:
     column_titles = ['Name (RIT Username)', 'Upperclassmen Score', 'Total Score', 'Upperclassmen', 'Freshmen',
             'Miscellaneous', 'Total Missed']
     data = list()
-    for packet in Packet.query.filter_by(end=end_date).all():
+    for packet in Packet.query.filter_by(end=end_date).options(joinedload(Packet.freshman)).all():
         received = packet.signatures_received()
         required = packet.signatures_required()
 
@@ -168,6 +188,16 @@ def extend_packet(packet_id: int) -> None:
     print('Packet successfully extended')
 
 
+def _publish_removed(packet: Packet, kind: str, username: str) -> None:
+    """
+    Tells open pages about a removed signature, the counter updates are flushed first to get the new counts
+    """
+    db.session.flush()
+    db.session.refresh(packet)
+    events.publish(events.signature_event(packet.id, kind, username, username, False, packet.signatures_received(),
+                                          packet.signatures_required()))
+
+
 def remove_sig(packet_id: int, username: str, is_member: bool) -> None:
     packet = Packet.by_id(packet_id)
 
@@ -177,12 +207,19 @@ def remove_sig(packet_id: int, username: str, is_member: bool) -> None:
     elif is_member:
         sig = UpperSignature.query.filter_by(packet_id=packet_id, member=username).first()
         if sig is not None:
-            sig.signed = False
+            if sig.signed:
+                sig.signed = False
+                packet.upper_signed = Packet.upper_signed - 1
+                packet.revision = Packet.revision + 1
+                _publish_removed(packet, 'upper', username)
             db.session.commit()
             print('Successfully unsigned packet')
         else:
             result = MiscSignature.query.filter_by(packet_id=packet_id, member=username).delete()
             if result == 1:
+                packet.misc_signed = Packet.misc_signed - 1
+                packet.revision = Packet.revision + 1
+                _publish_removed(packet, 'misc', username)
                 db.session.commit()
                 print('Successfully unsigned packet')
             else:
@@ -190,7 +227,11 @@ def remove_sig(packet_id: int, username: str, is_member: bool) -> None:
     else:
         sig = FreshSignature.query.filter_by(packet_id=packet_id, freshman_username=username).first()
         if sig is not None:
-            sig.signed = False
+            if sig.signed:
+                sig.signed = False
+                packet.fresh_signed = Packet.fresh_signed - 1
+                packet.revision = Packet.revision + 1
+                _publish_removed(packet, 'fresh', username)
             db.session.commit()
             print('Successfully unsigned packet')
         else:
@@ -217,3 +258,156 @@ def remove_freshman_sig(packet_id: int, freshman: str) -> None:
     :param freshman: The freshman's RIT username
     """
     remove_sig(packet_id, freshman, False)
+
+
+@app.cli.command('recount-signatures')
+@click.argument('packet_id', type=int, required=False)
+def recount_signatures(packet_id: Optional[int]) -> None:
+    """
+    Rebuilds the cached signature counts of every packet (or just the given one) from the signature tables.
+    """
+    if packet_id is None:
+        count = Packet.recount_signatures()
+    else:
+        count = Packet.recount_signatures(Packet.id == packet_id)
+    db.session.commit()
+
+    print('Recounted signatures for {} packet(s)'.format(count))
+
+
+@app.cli.command('explain-queries')
+@click.argument('member')
+@click.argument('freshman')
+def explain_queries(member: str, freshman: str) -> None:
+    """
+    Prints the query plans of the busiest pages' queries and flags any that sequentially scan a table.
+    :param member: A CSH username to run the member queries as
+    :param freshman: An RIT username to run the freshman queries as
+    """
+    queries: list[tuple[str, Any]] = []
+
+    # pylint: disable=unused-argument
+    def capture(conn: Any, cursor: Any, statement: str, parameters: Any, context: Any, executemany: bool) -> None:
+        if statement.lstrip().upper().startswith('SELECT'):
+            queries.append((statement, parameters))
+
+    event.listen(db.engine, 'before_cursor_execute', capture)
+    try:
+        Packet.open_summaries(member, True)
+        Packet.open_summaries(freshman, False)
+        stats.upperclassman_stats(member)
+        stats.upperclassmen_totals()
+        UpperSignature.query.filter_by(member=member).all()
+        FreshSignature.query.filter_by(freshman_username=freshman).all()
+        NotificationSubscription.query.filter_by(member=member).all()
+        NotificationSubscription.query.filter_by(freshman_username=freshman).all()
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', capture)
+
+    seq_scans = 0
+    connection = db.session.connection()
+    for statement, parameters in queries:
+        plan = [row[0] for row in connection.exec_driver_sql('EXPLAIN ' + statement, parameters)]
+        if any('Seq Scan' in line for line in plan):
+            seq_scans += 1
+            print('WARNING: Sequential scan in query plan')
+        print(statement)
+        print('\n'.join(plan), end='\n\n')
+    db.session.rollback()
+
+    print('{} of {} queries use a sequential scan'.format(seq_scans, len(queries)))
+
+
+@app.cli.command('run-worker')
+@click.option('--poll-interval', default=5.0, help='Seconds to wait between checks for new jobs.')
+@click.option('--once', is_flag=True, default=False, help='Exit once the queue is empty instead of polling.')
+def run_worker(poll_interval: float, once: bool) -> None:
+    """
+    Runs the queued notification, Slack, and mail jobs, retrying failed ones with exponential backoff.
+    """
+    count = jobs.run_worker(poll_interval, once)
+    print('Ran {} job(s)'.format(count))
+
+
+@app.cli.command('benchmark-mail')
+@click.option('--count', default=200, help='The number of start mails to send.')
+def benchmark_mail(count: int) -> None:
+    """
+    Times sending packet start mail to a local SMTP sink, first with a connection per mail and then as one batch.
+    """
+    # Only needed here, so it isn't loaded into the app otherwise
+    from .smtp_sink import SMTPSink  # pylint: disable=import-outside-toplevel
+
+    start = datetime.combine(date.today(), packet_start_time)
+    packets = [Packet(freshman=Freshman(name='Freshman {}'.format(i), rit_username='frosh{}'.format(i)), start=start)
+               for i in range(count)]
+
+    with SMTPSink(refuse={'frosh0@rit.edu'}) as sink:
+        # Connection is typed as taking a Mail but only reads the settings init_mail() returns
+        mail_state = cast(Mail, Mail().init_mail({'MAIL_SERVER': '127.0.0.1', 'MAIL_PORT': sink.port}))
+
+        started = datetime.now()
+        messages = [render_start_packet_mail(packet) for packet in packets]
+        print('Rendered {} mails in {:.3f}s'.format(count, (datetime.now() - started).total_seconds()))
+
+        started = datetime.now()
+        for msg in messages:
+            with Connection(mail_state) as connection:
+                try:
+                    connection.send(msg)
+                except smtplib.SMTPException:
+                    pass
+        print('Connection per mail: {:.3f}s over {} connections'.format(
+            (datetime.now() - started).total_seconds(), sink.connections))
+
+        connections = sink.connections
+        started = datetime.now()
+        failures = send_batch(messages, mail_state)
+        print('Batched: {:.3f}s over {} connection(s) with {} failed recipient(s)'.format(
+            (datetime.now() - started).total_seconds(), sink.connections - connections, len(failures)))
+
+
+@app.cli.command('benchmark-upperclassman-stats')
+@click.option('--seasons', default=4, help='The number of seasons of packets the member signed.')
+@click.option('--packets', default=60, help='The number of packets in each season.')
+def benchmark_upperclassman_stats(seasons: int, packets: int) -> None:
+    """
+    Times the upperclassman stats of a made up member who signed every packet of several seasons, as an upperclassman
+    for most and as a misc for the rest. The made up packets are rolled back afterwards.
+    """
+    member = 'benchmark-member'
+    signatures: list[Any] = []
+    for season in range(seasons):
+        start = datetime.combine(date.today() - timedelta(days=365 * (season + 1)), packet_start_time)
+        for i in range(packets):
+            packet = Packet(freshman=Freshman(name='Freshman {}'.format(i), rit_username='b{}-{}'.format(season, i),
+                                              onfloor=False),
+                            start=start, end=start + timedelta(days=14))
+            db.session.add(packet)
+            db.session.flush()
+            signed = start + timedelta(days=i % 14)
+            if i % 4:
+                signatures.append(UpperSignature(packet_id=packet.id, member=member, signed=True, updated=signed))
+            else:
+                signatures.append(MiscSignature(packet_id=packet.id, member=member, updated=signed))
+    db.session.add_all(signatures)
+    db.session.flush()
+
+    queries = 0
+
+    # pylint: disable=unused-argument
+    def count(conn: Any, cursor: Any, statement: str, parameters: Any, context: Any, executemany: bool) -> None:
+        nonlocal queries
+        queries += 1
+
+    event.listen(db.engine, 'before_cursor_execute', count)
+    try:
+        started = datetime.now()
+        result = stats.upperclassman_stats(member)
+        elapsed = (datetime.now() - started).total_seconds()
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', count)
+        db.session.rollback()
+
+    print('Fetched {} signatures over {} days in {:.3f}s with {} queries'.format(
+        sum(map(len, result['signatures'].values())), len(result['signatures']), elapsed, queries))
@@ -1,26 +1,88 @@
 """
 Context processors used by the jinja templates
 """
-import hashlib
-import urllib
 from functools import lru_cache
-from datetime import datetime
-from typing import Callable
+from datetime import datetime, timedelta
+from typing import Any, Callable, Iterable, Optional, cast
 
+from flask import url_for
+
+from packet.avatars import THUMBNAIL_SIZES
+from packet.cache import ttl_cache
 from packet.models import Freshman, UpperSignature
-from packet import app, ldap
+from packet import app, db, ldap
+
+# How often the name cache is resized to fit the current number of active members
+NAME_CACHE_RESIZE_INTERVAL = timedelta(hours=1)
+
+_name_cache_sized: Optional[datetime] = None
+
+
+# Failed lookups are only remembered for the miss TTL, so an LDAP hiccup doesn't leave raw uids on pages for long
+@ttl_cache(maxsize=app.config['LDAP_MEMBER_CACHE_SIZE'], ttl=app.config['LDAP_MEMBER_CACHE_TTL'],
+           miss_ttl=app.config['LDAP_MEMBER_MISS_TTL'], miss_exceptions=(Exception,))
+def lookup_csh_name(username: str) -> str:
+    """
+    :return: The member's display name
+    :raises Exception: If the member doesn't exist or LDAP couldn't be reached
+    """
+    member = ldap.get_member(username)
+    return member.cn + ' (' + member.uid + ')'
 
 
-# pylint: disable=bare-except
-@lru_cache(maxsize=128)
 def get_csh_name(username: str) -> str:
+    """
+    :return: The member's display name, or their username if it couldn't be looked up
+    """
     try:
-        member = ldap.get_member(username)
-        return member.cn + ' (' + member.uid + ')'
-    except:
+        return lookup_csh_name(username)
+    except Exception:  # pylint: disable=broad-except
         return username
 
 
+def _resize_name_cache() -> None:
+    """
+    Makes room in the name cache for every active member, with as much again for alumni and advisors
+    """
+    global _name_cache_sized  # pylint: disable=global-statement
+    now = datetime.now()
+    if _name_cache_sized is not None and now - _name_cache_sized < NAME_CACHE_RESIZE_INTERVAL:
+        return
+    _name_cache_sized = now
+    try:
+        lookup_csh_name.resize(max(2 * len(ldap.get_active_members()), 1))
+    except Exception as e:  # pylint: disable=broad-except
+        app.logger.warn('Failed to size the name cache: {!r}'.format(e))
+
+
+def get_csh_names(usernames: Iterable[str]) -> dict[str, str]:
+    """
+    Looks up the display names of many members at once, only the ones that aren't cached are fetched from LDAP and
+    they're fetched together
+    :return: A dict of username to display name, for passing to a template instead of calling get_csh_name per row
+    """
+    _resize_name_cache()
+    usernames = set(usernames)
+    missing = {username for username in usernames if not lookup_csh_name.is_cached(username)}
+    names = {username: get_csh_name(username) for username in usernames - missing}
+    if not missing:
+        return names
+
+    try:
+        found = ldap.get_names(missing)
+    except Exception as e:  # pylint: disable=broad-except
+        app.logger.warn('Failed to look up {} names: {!r}'.format(len(missing), e))
+        names.update({username: username for username in missing})
+        return names
+    for username in missing:
+        if username in found:
+            names[username] = found[username] + ' (' + username + ')'
+            lookup_csh_name.put(names[username], username)
+        else:
+            names[username] = username
+    return names
+
+
 def get_roles(sig: UpperSignature) -> dict[str, str]:
     """
     Converts a signature's role fields to a dict for ease of access.
@@ -54,20 +116,26 @@ def get_rit_name(username: str) -> str:
         return username
 
 
-# pylint: disable=bare-except
-@lru_cache(maxsize=256)
-def get_rit_image(username: str) -> str:
-    if username:
-        addresses = [username + '@rit.edu', username + '@g.rit.edu']
-        for addr in addresses:
-            url = 'https://gravatar.com/avatar/' + hashlib.md5(addr.encode('utf8')).hexdigest() + '.jpg?d=404&s=250'
-            try:
-                with urllib.request.urlopen(url) as gravatar:
-                    if gravatar.getcode() == 200:
-                        return url
-            except:
-                continue
-    return 'https://www.gravatar.com/avatar/freshmen?d=mp&f=y'
+def get_rit_names(usernames: Iterable[str]) -> dict[str, str]:
+    """
+    Looks up the display names of many freshmen with a single query
+    :return: A dict of username to display name, for passing to a template instead of calling get_rit_name per row
+    """
+    usernames = set(usernames)
+    found = dict(db.session.query(Freshman.rit_username, Freshman.name)
+                 .filter(cast(Any, Freshman.rit_username).in_(usernames)))
+    return {username: found[username] + ' (' + username + ')' if username in found else username
+            for username in usernames}
+
+
+def avatar_url(kind: str, username: str, size: int = THUMBNAIL_SIZES[0]) -> str:
+    """
+    :param kind: 'csh' for a member or 'rit' for a freshman
+    :return: The URL of the user's cached thumbnail
+    """
+    if size == THUMBNAIL_SIZES[0]:
+        return url_for('avatar', kind=kind, username=username)
+    return url_for('avatar', kind=kind, username=username, s=size)
 
 
 def log_time(label: str) -> None:
@@ -80,6 +148,6 @@ def log_time(label: str) -> None:
 @app.context_processor
 def utility_processor() -> dict[str, Callable]:
     return dict(
-        get_csh_name=get_csh_name, get_rit_name=get_rit_name, get_rit_image=get_rit_image, log_time=log_time,
-        get_roles=get_roles
+        get_csh_name=get_csh_name, get_rit_name=get_rit_name, log_time=log_time,
+        get_roles=get_roles, avatar_url=avatar_url
     )
@@ -0,0 +1,210 @@
+"""
+Live signature events for the packet pages
+
+Events are published with Postgres NOTIFY in the same transaction as the signature, so they go out only once it's
+committed and every process sees every signature. Each process has one thread LISTENing on a dedicated connection that
+hands events to the Server-Sent Event streams it's serving.
+"""
+import json
+import queue
+import select
+import threading
+import time
+from typing import Any, Callable, Iterator, Optional
+
+from flask import Response
+
+from packet import app, db
+from packet.models import SigCounts
+
+CHANNEL = 'packet_events'
+
+# How often an idle stream sends a comment, which keeps proxies from timing it out and notices closed connections
+KEEPALIVE_SECONDS = 15
+
+# How many events a stream can fall behind by before it's closed, after which the browser reconnects
+STREAM_BACKLOG = 100
+
+_lock = threading.Lock()
+_streams: dict[int, tuple[Optional[int], queue.Queue]] = dict()
+_next_stream = 0
+_listener: Optional[threading.Thread] = None
+
+
+def signature_event(packet_id: int, kind: str, signer: str, name: str, signed: bool, received: SigCounts,
+                    required: SigCounts) -> dict[str, Any]:
+    """
+    :param kind: The type of signature, one of 'upper', 'fresh', or 'misc'
+    :param name: The signer's display name
+    :param signed: False when a signature was removed
+    :return: The event describing a signature and the packet's counts after it, as streamed to the packet pages
+    """
+    return {
+        'packet_id': packet_id,
+        'kind': kind,
+        'signer': signer,
+        'name': name,
+        'signed': signed,
+        'received': vars(received),
+        'required': vars(required),
+        'is_100': received.total == required.total,
+    }
+
+
+def counts_event(packet_id: int, received: SigCounts, required: SigCounts) -> dict[str, Any]:
+    """
+    :return: An event with only the packet's new counts, for changes that aren't a single signature, streamed the same
+             way as the events from signature_event()
+    """
+    return {
+        'packet_id': packet_id,
+        'received': vars(received),
+        'required': vars(required),
+        'is_100': received.total == required.total,
+    }
+
+
+def publish(event: dict[str, Any]) -> None:
+    """
+    Queues an event from signature_event() or counts_event(), Postgres delivers it to the listeners when the current
+    transaction commits
+    """
+    db.session.execute(db.func.pg_notify(CHANNEL, json.dumps(event)).select())
+
+
+def _dispatch(event: Optional[dict]) -> None:
+    """
+    :param event: The event to hand to every interested stream, or None to close every stream
+    """
+    with _lock:
+        streams = list(_streams.items())
+    for stream_id, (packet_id, events) in streams:
+        if event is not None and packet_id is not None and event['packet_id'] != packet_id:
+            continue
+        try:
+            events.put_nowait(event)
+        except queue.Full:
+            app.logger.warn('Closing event stream {} since it fell too far behind'.format(stream_id))
+            _close(stream_id)
+
+
+def _close(stream_id: int) -> None:
+    with _lock:
+        stream = _streams.pop(stream_id, None)
+    if stream is not None:
+        # Make room for the sentinel so the stream wakes up and ends
+        while True:
+            try:
+                stream[1].put_nowait(None)
+                return
+            except queue.Full:
+                try:
+                    stream[1].get_nowait()
+                except queue.Empty:
+                    pass
+
+
+def _listen() -> None:
+    """
+    Passes every NOTIFY on CHANNEL to _dispatch, reconnecting whenever the connection is lost
+    """
+    while True:
+        connection = None
+        try:
+            with app.app_context():
+                fairy = db.engine.raw_connection()
+            # The connection sits in LISTEN for the life of the process, so don't hold a spot in the pool for it
+            fairy.detach()
+            connection = fairy.connection
+            connection.autocommit = True
+            connection.cursor().execute('LISTEN ' + CHANNEL)
+            app.logger.info('Listening for packet events')
+            while True:
+                if select.select([connection], [], [], KEEPALIVE_SECONDS) == ([], [], []):
+                    continue
+                connection.poll()
+                while connection.notifies:
+                    _dispatch(json.loads(connection.notifies.pop(0).payload))
+        except Exception as e:  # pylint: disable=broad-except
+            app.logger.warn('Lost the packet event connection, reconnecting: {!r}'.format(e))
+            if connection is not None:
+                try:
+                    connection.close()
+                except Exception:  # pylint: disable=broad-except
+                    pass
+            # Events may have been missed while disconnected, so close every stream rather than leave it silently behind
+            _dispatch(None)
+            time.sleep(KEEPALIVE_SECONDS)
+
+
+def _subscribe(packet_id: Optional[int]) -> tuple[int, queue.Queue]:
+    global _next_stream, _listener  # pylint: disable=global-statement
+    events: queue.Queue = queue.Queue(maxsize=STREAM_BACKLOG)
+    with _lock:
+        if _listener is None:
+            _listener = threading.Thread(target=_listen, name='packet-events', daemon=True)
+            _listener.start()
+        if len(_streams) >= app.config['STREAM_MAX_CONNECTIONS']:
+            raise OverflowError('Too many event streams')
+        _next_stream += 1
+        _streams[_next_stream] = (packet_id, events)
+        return _next_stream, events
+
+
+def _events(stream_id: int, events: queue.Queue, visible: Callable[[dict], Optional[dict]]) -> Iterator[bytes]:
+    deadline = time.monotonic() + app.config['STREAM_MAX_SECONDS']
+    try:
+        # Have the browser wait a bit before reconnecting so a restart isn't met by every viewer at once
+        yield b'retry: 5000\n\n'
+        while time.monotonic() < deadline:
+            try:
+                event = events.get(timeout=KEEPALIVE_SECONDS)
+            except queue.Empty:
+                yield b': keepalive\n\n'
+                continue
+            if event is None:
+                return
+            event = visible(event)
+            if event is not None:
+                yield ('event: signature\ndata: ' + json.dumps(event) + '\n\n').encode()
+    finally:
+        _close(stream_id)
+
+
+def event_stream(packet_id: Optional[int], visible: Callable[[dict], Optional[dict]]) -> Response:
+    """
+    Streams signature events as Server-Sent Events until the client goes away or STREAM_MAX_SECONDS pass, after which
+    the browser reconnects
+    :param packet_id: Only stream events for this packet, or None for every packet
+    :param visible: Trims each event down to what the viewer is allowed to see, or returns None to skip it
+    """
+    try:
+        stream_id, events = _subscribe(packet_id)
+    except OverflowError:
+        return Response('Too many event streams', status=503, headers={'Retry-After': '60'})
+
+    response = Response(_events(stream_id, events, visible), mimetype='text/event-stream')
+    # The generator only cleans up after itself once it's started, so also clean up if the client leaves before then
+    response.call_on_close(lambda: _close(stream_id))
+    response.cache_control.no_cache = True
+    response.headers['X-Accel-Buffering'] = 'no'
+    # Keeps Gzip from buffering the endless body, which means the body has to be bytes already
+    response.direct_passthrough = True
+    return response
+
+
+def signature_visible_to(info: dict[str, Any], full: bool = False) -> Callable[[dict], Optional[dict]]:
+    """
+    :param full: Set to True if the viewer can see every signature of the packets being streamed
+    :return: A filter for event_stream() that marks the viewer's own signatures and hides who signed from viewers who
+             can't see a packet's signatures
+    """
+    def visible(event: dict) -> Optional[dict]:
+        if 'signer' not in event:
+            return event
+        # Freshmen sign with their RIT username and members with their CSH one, so only compare within a realm
+        own = event['signer'] == info['uid'] and (event['kind'] == 'fresh') == (info['realm'] == 'intro')
+        if full or info['is_upper'] or own:
+            return {**event, 'own': own}
+        return {key: value for key, value in event.items() if key not in ('signer', 'name')}
+    return visible
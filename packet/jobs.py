@@ -0,0 +1,172 @@
+"""
+A persistent queue for work that talks to outside services (OneSignal, Slack, and SMTP) so requests never wait on them
+
+Jobs are added to the DB session with enqueue() so they commit or roll back along with the change that caused them, and
+are run by the `flask run-worker` command
+"""
+import time
+from datetime import datetime, timedelta
+from typing import Any, Callable, TypeVar, cast
+
+from packet import app, db
+from packet.mail import send_report_mail, send_start_packet_mail, send_start_packet_mails
+from packet.models import Job, Packet, SignedNotificationBatch
+from packet.notifications import packet_signed_notification, packet_100_percent_notification, \
+    packet_starting_notification, packets_starting_notification, notify_slack
+
+WrappedFunc = TypeVar('WrappedFunc', bound=Callable)
+
+# The realms that are told when a packet reaches 100%
+NOTIFICATION_REALMS = ('csh', 'intro')
+
+_handlers: dict[str, Callable[..., None]] = dict()
+
+def job_handler(kind: str) -> Callable[[WrappedFunc], WrappedFunc]:
+    """
+    Registers the decorated function as the handler for jobs of the given kind, it's called with the job's payload
+    """
+    def register(func: WrappedFunc) -> WrappedFunc:
+        _handlers[kind] = func
+        return func
+    return register
+
+
+def enqueue(kind: str, delay: timedelta = timedelta(), **payload: Any) -> None:
+    """
+    Adds a job to the current DB session, it's only run once the session commits
+    :param delay: How long after now to wait before running the job
+    :param payload: JSON serializable keyword arguments for the job's handler
+    """
+    if kind not in _handlers:
+        raise ValueError('Unknown job kind: ' + kind)
+    db.session.add(Job(kind=kind, payload=payload, run_after=datetime.now() + delay))
+
+
+def enqueue_signed_notification(packet_id: int, signer: str) -> None:
+    """
+    Adds a signer to the packet's pending "signed your packet" notification, the first signer in a batch queues the
+    job that sends it once the realm's SIGNED_NOTIFICATION_WINDOW has passed
+    """
+    if SignedNotificationBatch.add(packet_id, signer):
+        window = app.config['SIGNED_NOTIFICATION_WINDOW'][app.config['REALM']]
+        enqueue('packet_signed', delay=timedelta(seconds=window), packet_id=packet_id)
+
+
+@job_handler('packet_signed')
+def _packet_signed(packet_id: int) -> None:
+    signers = SignedNotificationBatch.take(packet_id)
+    if not signers:
+        return
+    try:
+        packet_signed_notification(Packet.by_id(packet_id), signers)
+    except Exception:
+        # The batch was taken in its own transaction, so hand the signers back for the retry to send
+        SignedNotificationBatch.restore(packet_id, signers)
+        raise
+
+
+def enqueue_100_percent_notifications(packet_id: int) -> None:
+    """
+    Queues the 100% notification separately for each realm, so a retry only re-sends to the realm that failed
+    """
+    for realm in NOTIFICATION_REALMS:
+        enqueue('packet_100_percent', packet_id=packet_id, realm=realm)
+
+
+@job_handler('packet_100_percent')
+def _packet_100_percent(packet_id: int, realm: str) -> None:
+    packet_100_percent_notification(Packet.by_id(packet_id), realm)
+
+
+@job_handler('slack_100_percent')
+def _slack_100_percent(packet_id: int) -> None:
+    notify_slack(Packet.by_id(packet_id).freshman.name)
+
+
+@job_handler('packet_starting')
+def _packet_starting(packet_id: int) -> None:
+    packet_starting_notification(Packet.by_id(packet_id))
+
+
+@job_handler('packets_starting')
+def _packets_starting(start: str) -> None:
+    packets_starting_notification(datetime.fromisoformat(start))
+
+
+@job_handler('packet_start_mail')
+def _packet_start_mail(packet_id: int) -> None:
+    send_start_packet_mail(Packet.by_id(packet_id))
+
+
+@job_handler('packet_start_mails')
+def _packet_start_mails(packet_ids: list[int]) -> None:
+    packets = Packet.query.filter(cast(Any, Packet.id).in_(packet_ids)).all()
+    failures = send_start_packet_mails(packets)
+    # Only the freshmen who didn't get their mail are retried, each in their own job
+    for packet in packets:
+        recipient = '<' + packet.freshman_username + '@rit.edu>'
+        if recipient in failures:
+            app.logger.warn('Start mail to {} failed: {}'.format(recipient, failures[recipient]))
+            enqueue('packet_start_mail', delay=retry_delay(1), packet_id=packet.id)
+
+
+@job_handler('report_mail')
+def _report_mail(person: str, report: str, reporter: str) -> None:
+    send_report_mail({'person': person, 'report': report}, reporter)
+
+
+def retry_delay(attempts: int) -> timedelta:
+    """
+    :return: How long to wait before retrying a job that has failed the given number of times
+    """
+    return min(timedelta(seconds=app.config['JOB_RETRY_SECONDS'] * 2 ** (attempts - 1)),
+               timedelta(seconds=app.config['JOB_RETRY_MAX_SECONDS']))
+
+
+def run_next_job() -> bool:
+    """
+    Claims and runs the oldest due job, the row stays locked until it's done so any number of workers can run at once
+    A job that fails is rescheduled with exponential backoff, once it runs out of attempts it's left in the table
+    :return: False if there weren't any jobs to run
+    """
+    job = Job.query \
+        .filter(Job.run_after <= datetime.now(), Job.attempts < app.config['JOB_MAX_ATTEMPTS']) \
+        .order_by(Job.run_after, Job.id) \
+        .with_for_update(skip_locked=True) \
+        .first()
+    if job is None:
+        db.session.rollback()
+        return False
+
+    try:
+        # Run the handler in a savepoint so a DB error inside it doesn't also cost us the lock on the job
+        with db.session.begin_nested():
+            _handlers[job.kind](**job.payload)
+    except Exception as e:  # pylint: disable=broad-except
+        job.attempts += 1
+        job.last_error = repr(e)
+        if job.attempts < app.config['JOB_MAX_ATTEMPTS']:
+            job.run_after = datetime.now() + retry_delay(job.attempts)
+            app.logger.warn('Job {} ({}) failed, retrying at {}: {!r}'.format(job.id, job.kind, job.run_after, e))
+        else:
+            app.logger.error('Job {} ({}) failed for the last time: {!r}'.format(job.id, job.kind, e))
+    else:
+        db.session.delete(job)
+        app.logger.info('Ran job {} ({})'.format(job.id, job.kind))
+    db.session.commit()
+    return True
+
+
+def run_worker(poll_interval: float, once: bool = False) -> int:
+    """
+    Runs jobs until the queue is empty, then polls for new ones every poll_interval seconds
+    :param once: Return as soon as the queue is empty instead of polling
+    :return: The number of jobs run, counting each retry
+    """
+    count = 0
+    while True:
+        while run_next_job():
+            count += 1
+        if once:
+            return count
+        time.sleep(poll_interval)
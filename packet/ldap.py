@@ -2,13 +2,27 @@
 Helper functions for working with the csh_ldap library
 """
 
-from functools import lru_cache
-from datetime import date
-from typing import Optional, cast, Any
+import threading
+from datetime import date, datetime, timedelta
+from typing import Iterable, Optional, Union, cast, Any
 
 from csh_ldap import CSHLDAP, CSHMember
+from ldap import SCOPE_SUBTREE
+from ldap.filter import escape_filter_chars
 
 from packet import app
+from packet.cache import TTLCache
+
+USERS_OU = 'cn=users,cn=accounts,dc=csh,dc=rit,dc=edu'
+GROUPS_OU = 'cn=groups,cn=accounts,dc=csh,dc=rit,dc=edu'
+
+# Members of any of these groups are included in directory snapshots
+SNAPSHOT_GROUPS = (
+    'active', 'intromembers', 'onfloor', 'fall_coop', 'spring_coop', 'rtp', 'active_rtp', '3da', 'webmaster',
+    'constitutional_maintainers', 'wiki_maintainers', 'drink', 'eboard', 'eboard-chairman', 'eboard-evaluations',
+    'eboard-financial', 'eboard-history', 'eboard-imps', 'eboard-opcomm', 'eboard-research', 'eboard-social',
+    'eboard-pr', 'eboard-secretary',
+)
 
 
 class MockMember:
@@ -39,21 +53,169 @@ class MockMember:
         return f'MockMember(uid: {self.uid}, groups: {self.groups})'
 
 
+class SnapshotMember:
+    """
+    A member as of the last directory snapshot, it has the attributes packet reads off of a CSHMember without needing
+    an LDAP round trip for each one
+    """
+
+    def __init__(self, uid: str, cn: str, groups: frozenset[str], room_number: Optional[int] = None,
+                 ritdn: Optional[str] = None):
+        self.uid = uid
+        self.cn = cn # pylint: disable=invalid-name
+        self.groups = groups
+        self.ritdn = ritdn
+        if room_number:
+            self.roomNumber = room_number # pylint: disable=invalid-name
+
+
+    def __eq__(self, other: Any) -> bool:
+        if type(other) is type(self):
+            return self.uid == other.uid
+        return False
+
+
+    def __hash__(self) -> int:
+        return hash(self.uid)
+
+
+    def __repr__(self) -> str:
+        return f'SnapshotMember(uid: {self.uid}, groups: {sorted(self.groups)})'
+
+
+class DirectorySnapshot:
+    """
+    Every member of SNAPSHOT_GROUPS with their groups, indexed both ways
+    """
+
+    def __init__(self, members: list[SnapshotMember]):
+        self.loaded = datetime.now()
+        self.members = {member.uid: member for member in members}
+        group_uids: dict[str, set[str]] = {group: set() for group in SNAPSHOT_GROUPS}
+        for member in members:
+            for group in member.groups:
+                group_uids.setdefault(group, set()).add(member.uid)
+        self.group_uids = {group: frozenset(uids) for group, uids in group_uids.items()}
+
+
+AnyMember = Union[CSHMember, MockMember, SnapshotMember]
+
+
 class LDAPWrapper:
 
-    def __init__(self, cshldap: Optional[CSHLDAP] = None, mock_members: Optional[list[MockMember]] = None):
+    def __init__(self, cshldap: Optional[CSHLDAP] = None, mock_members: Optional[list[MockMember]] = None,
+                 snapshot_ttl: int = 0):
+        """
+        :param snapshot_ttl: How many seconds a directory snapshot is used before it's reloaded, 0 turns snapshots off
+        """
         self.ldap = cshldap
         self.mock_members = cast(list[MockMember], mock_members)
+        self.snapshot_ttl = timedelta(seconds=snapshot_ttl)
+        self._snapshot: Optional[DirectorySnapshot] = None
+        self._snapshot_lock = threading.Lock()
+        # Members that don't exist are remembered for a shorter time so they can't be looked up over and over
+        self._member_cache = TTLCache(self._lookup_member, maxsize=app.config['LDAP_MEMBER_CACHE_SIZE'],
+                                      ttl=app.config['LDAP_MEMBER_CACHE_TTL'],
+                                      miss_ttl=app.config['LDAP_MEMBER_MISS_TTL'], miss_exceptions=(KeyError,))
+        self.member_cache_info = self._member_cache.cache_info
         if self.ldap:
             app.logger.info('LDAP configured with CSH LDAP')
         else:
             app.logger.info('LDAP configured with local mock')
 
 
+    def _load_snapshot(self) -> DirectorySnapshot:
+        """
+        Loads every member of SNAPSHOT_GROUPS along with all of their groups in a single search
+        """
+        if not self.ldap:
+            return DirectorySnapshot([SnapshotMember(member.uid, member.cn, frozenset(member.groups),
+                                                     getattr(member, 'room_number', None),
+                                                     getattr(member, 'ritdn', None))
+                                      for member in self.mock_members])
+
+        group_filter = ''.join('(memberOf=cn={},{})'.format(group, GROUPS_OU) for group in SNAPSHOT_GROUPS)
+        results = self.ldap.get_con().search_s(USERS_OU, SCOPE_SUBTREE, '(|{})'.format(group_filter),
+                                               ['uid', 'cn', 'memberOf', 'roomNumber', 'ritDn'])
+        members = []
+        for _, attrs in results:
+            # Attribute names come back in the schema's case
+            attrs = {name.lower(): values for name, values in attrs.items()}
+            if 'uid' not in attrs:
+                continue
+            groups = frozenset(group_dn.split(',')[0][3:] for group_dn in
+                               (value.decode('utf-8') for value in attrs.get('memberof', []))
+                               if group_dn.split(',')[1] == 'cn=groups')
+            room_number = attrs.get('roomnumber', [None])[0]
+            ritdn = attrs.get('ritdn', [None])[0]
+            members.append(SnapshotMember(attrs['uid'][0].decode('utf-8'),
+                                          attrs.get('cn', attrs['uid'])[0].decode('utf-8'),
+                                          groups,
+                                          int(room_number) if room_number else None,
+                                          ritdn.decode('utf-8') if ritdn else None))
+        return DirectorySnapshot(members)
+
+
+    def _current_snapshot(self, refresh: bool = False) -> Optional[DirectorySnapshot]:
+        """
+        While one thread reloads an expired snapshot the others keep using the old one, and if reloading fails the old
+        one is used for another snapshot_ttl
+        :param refresh: Reload the snapshot even if it hasn't expired yet
+        :return: The current directory snapshot, or None if snapshots are turned off
+        """
+        if not self.snapshot_ttl:
+            return None
+        current = self._snapshot
+        if current is not None and not refresh and datetime.now() - current.loaded < self.snapshot_ttl:
+            return current
+
+        if not self._snapshot_lock.acquire(blocking=current is None or refresh): # pylint: disable=consider-using-with
+            return current
+        try:
+            # Someone else may have reloaded it while we were waiting
+            if self._snapshot is current:
+                try:
+                    self._snapshot = self._load_snapshot()
+                    app.logger.info('Loaded an LDAP snapshot of {} members'.format(len(self._snapshot.members)))
+                except Exception as e: # pylint: disable=broad-except
+                    if current is None:
+                        raise
+                    app.logger.warn('Failed to reload the LDAP snapshot, using the old one: {!r}'.format(e))
+                    current.loaded = datetime.now()
+            return self._snapshot
+        finally:
+            self._snapshot_lock.release()
+
+
+    @staticmethod
+    def _uid(member: AnyMember) -> str:
+        if isinstance(member, (MockMember, SnapshotMember)):
+            return member.uid
+        # Read the uid out of the DN since asking a CSHMember for it is another search
+        return member.get_dn().split(',')[0][len('uid='):]
+
+
+    def _snapshot_groups(self, member: AnyMember) -> Optional[frozenset[str]]:
+        """
+        :return: The member's groups according to the snapshot, or None if they have to be looked up
+        """
+        snapshot = self._current_snapshot()
+        if snapshot is None:
+            return member.groups if isinstance(member, SnapshotMember) else None
+        entry = snapshot.members.get(self._uid(member))
+        if entry is not None:
+            return entry.groups
+        # A member from an older snapshot who isn't in any of the snapshot groups anymore
+        return frozenset() if isinstance(member, SnapshotMember) else None
+
+
     def _get_group_members(self, group: str) -> list[CSHMember]:
         """
-        :return: A list of CSHMember instances
+        :return: A list of CSHMember instances, or SnapshotMember instances when snapshots are on
         """
+        snapshot = self._current_snapshot()
+        if snapshot is not None and group in SNAPSHOT_GROUPS:
+            return [snapshot.members[uid] for uid in snapshot.group_uids[group]]
         if self.ldap:
             return self.ldap.get_group(group).get_members()
         else:
@@ -64,6 +226,9 @@ class LDAPWrapper:
         """
         :param member: A CSHMember instance
         """
+        groups = self._snapshot_groups(member)
+        if groups is not None:
+            return group in groups
         if self.ldap:
             for group_dn in member.get('memberOf'):
                 if group == group_dn.split(',')[0][3:]:
@@ -73,6 +238,9 @@ class LDAPWrapper:
             return group in member.groups
 
     def get_groups(self, member: CSHMember) -> list[str]:
+        groups = self._snapshot_groups(member)
+        if groups is not None:
+            return list(groups)
         if self.ldap:
             return list(
                     map(
@@ -91,13 +259,10 @@ class LDAPWrapper:
 
 
 
-    # Getters
-
-    @lru_cache(maxsize=256)
-    def get_member(self, username: str) -> CSHMember:
-        """
-        :return: A CSHMember instance
-        """
+    def _lookup_member(self, username: str) -> CSHMember:
+        snapshot = self._current_snapshot()
+        if snapshot is not None and username in snapshot.members:
+            return snapshot.members[username]
         if self.ldap:
             return self.ldap.get_member(username, uid=True)
         else:
@@ -107,6 +272,50 @@ class LDAPWrapper:
             raise KeyError('Invalid Search Name')
 
 
+    # Getters
+
+    def get_member(self, username: str) -> CSHMember:
+        """
+        :return: A CSHMember instance, or the member's SnapshotMember if they're in the snapshot
+        """
+        return self._member_cache(username)
+
+
+    def clear_member_cache(self) -> None:
+        """
+        Reloads the directory snapshot and forgets every cached member, so changes to their groups and newly added
+        members are seen straight away
+        """
+        self._current_snapshot(refresh=True)
+        self._member_cache.cache_clear()
+
+
+    def get_names(self, uids: Iterable[str]) -> dict[str, str]:
+        """
+        Looks up many members' common names at once, from the snapshot where possible and with a single search for the
+        rest
+        :return: A dict of uid to common name, members that don't exist are left out
+        """
+        uids = set(uids)
+        names: dict[str, str] = dict()
+        snapshot = self._current_snapshot()
+        if snapshot is not None:
+            names.update({uid: snapshot.members[uid].cn for uid in uids if uid in snapshot.members})
+
+        missing = uids - names.keys()
+        if not missing:
+            return names
+        if self.ldap:
+            uid_filter = ''.join('(uid={})'.format(escape_filter_chars(uid)) for uid in sorted(missing))
+            results = self.ldap.get_con().search_s(USERS_OU, SCOPE_SUBTREE, '(|{})'.format(uid_filter), ['uid', 'cn'])
+            for _, attrs in results:
+                if 'uid' in attrs:
+                    names[attrs['uid'][0].decode('utf-8')] = attrs.get('cn', attrs['uid'])[0].decode('utf-8')
+        else:
+            names.update({member.uid: member.cn for member in self.mock_members if member.uid in missing})
+        return names
+
+
     def get_active_members(self) -> list[CSHMember]:
         """
         Gets all current, dues-paying members
@@ -145,7 +354,7 @@ class LDAPWrapper:
         members = []
         onfloor = self._get_group_members('onfloor')
         for member in onfloor:
-            if self.get_roomnumber(member) and not self.is_eboard(member):
+            if self._get_roomnumber(member) and not self.is_eboard(member):
                 members.append(member)
 
         return members
@@ -263,7 +472,8 @@ class LDAPWrapper:
             return self._is_member_of_group(member, 'spring_coop')
 
 
-    def get_roomnumber(self, member: CSHMember) -> Optional[int]: # pylint: disable=no-self-use
+    @staticmethod
+    def _get_roomnumber(member: CSHMember) -> Optional[int]:
         """
         :param member: A CSHMember instance
         """
@@ -276,7 +486,8 @@ class LDAPWrapper:
 if app.config['LDAP_BIND_DN'] and app.config['LDAP_BIND_PASS']:
     ldap = LDAPWrapper(cshldap=CSHLDAP(app.config['LDAP_BIND_DN'],
                                      app.config['LDAP_BIND_PASS']
-                                    )
+                                    ),
+                       snapshot_ttl=app.config['LDAP_SNAPSHOT_TTL']
 )
 else:
     ldap = LDAPWrapper(
@@ -285,5 +496,6 @@ else:
                     lambda mock_dict: MockMember(**mock_dict),
                     app.config['LDAP_MOCK_MEMBERS']
                    )
-                )
+                ),
+            snapshot_ttl=app.config['LDAP_SNAPSHOT_TTL']
             )
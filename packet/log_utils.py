@@ -7,7 +7,7 @@ from datetime import datetime
 from typing import Any, Callable, TypeVar, cast
 
 from packet import app, ldap
-from packet.context_processors import get_rit_name
+from packet.context_processors import get_rit_name, lookup_csh_name
 from packet.utils import is_freshman_on_floor
 
 WrappedFunc = TypeVar('WrappedFunc', bound=Callable)
@@ -30,17 +30,23 @@ def log_time(func: WrappedFunc) -> WrappedFunc:
     return cast(WrappedFunc, wrapped_function)
 
 
-def _format_cache(func: Any) -> str:
+def _format_cache(name: str, cache_info: Callable[[], Any]) -> str:
     """
-    :return: The output of func.cache_info() as a compactly formatted string
+    :return: The output of cache_info() as a compactly formatted string
     """
-    info = func.cache_info()
-    return '{}[hits={}, misses={}, size={}/{}]'.format(func.__name__, info.hits, info.misses, info.currsize,
-                                                       info.maxsize)
+    info = cache_info()
+    expired = ', expired={}'.format(info.expired) if hasattr(info, 'expired') else ''
+    return '{}[hits={}, misses={}{}, size={}/{}]'.format(name, info.hits, info.misses, expired, info.currsize,
+                                                         info.maxsize)
 
 
-# Tuple of lru_cache functions to log stats from
-_caches = (get_rit_name, ldap.get_member, is_freshman_on_floor)
+# The cache_info() of each lru_cache and TTLCache to log stats from, by name
+_caches: dict[str, Callable[[], Any]] = {
+    'lookup_csh_name': lookup_csh_name.cache_info,
+    'get_rit_name': get_rit_name.cache_info,
+    'get_member': ldap.member_cache_info,
+    'is_freshman_on_floor': is_freshman_on_floor.cache_info,
+}
 
 
 def log_cache(func: WrappedFunc) -> WrappedFunc:
@@ -52,7 +58,8 @@ def log_cache(func: WrappedFunc) -> WrappedFunc:
     def wrapped_function(*args: list, **kwargs: dict) -> Any:
         result = func(*args, **kwargs)
 
-        app.logger.info('Cache stats: ' + ', '.join(map(_format_cache, _caches)))
+        app.logger.info('Cache stats: ' + ', '.join(_format_cache(name, cache_info)
+                                                    for name, cache_info in _caches.items()))
 
         return result
 
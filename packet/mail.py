@@ -1,7 +1,8 @@
-from typing import TypedDict, List, Union, cast
+import smtplib
+from typing import Any, TypedDict, List, Optional, Union, cast
 
 from flask import render_template
-from flask_mail import Mail, Message
+from flask_mail import Connection, Mail, Message
 
 from packet import app
 from packet.models import Packet
@@ -13,19 +14,59 @@ class ReportForm(TypedDict):
     person: str
     report: str
 
+def _address(recipient: Union[str, tuple[str, str]]) -> str:
+    """
+    :return: The address of a recipient given either as an address or as a (name, address) pair
+    """
+    return recipient if isinstance(recipient, str) else recipient[1]
+
+def render_start_packet_mail(packet: Packet) -> Message:
+    recipients = ['<' + str(packet.freshman.rit_username) + '@rit.edu>']
+    msg = Message(subject='CSH Packet Starts ' + packet.start.strftime('%A, %B %-d'),
+                  sender=app.config.get('MAIL_USERNAME'),
+                  recipients=cast(List[Union[str, tuple[str, str]]], recipients))
+
+    template = 'mail/packet_start'
+    msg.body = render_template(template + '.txt', packet=packet)
+    msg.html = render_template(template + '.html', packet=packet)
+    return msg
+
 def send_start_packet_mail(packet: Packet) -> None:
     if app.config['MAIL_PROD']:
-        recipients = ['<' + str(packet.freshman.rit_username) + '@rit.edu>']
-        msg = Message(subject='CSH Packet Starts ' + packet.start.strftime('%A, %B %-d'),
-                      sender=app.config.get('MAIL_USERNAME'),
-                      recipients=cast(List[Union[str, tuple[str, str]]], recipients))
-
-        template = 'mail/packet_start'
-        msg.body = render_template(template + '.txt', packet=packet)
-        msg.html = render_template(template + '.html', packet=packet)
-        app.logger.info('Sending mail to ' + recipients[0])
+        msg = render_start_packet_mail(packet)
+        app.logger.info('Sending mail to ' + _address(msg.recipients[0]))
         mail.send(msg)
 
+def send_start_packet_mails(packets: list[Packet]) -> dict[str, str]:
+    """
+    Sends the start mail to each of the given packets' freshmen over a single SMTP connection
+    :return: The error for each recipient that couldn't be sent to
+    """
+    if not app.config['MAIL_PROD']:
+        return dict()
+    return send_batch([render_start_packet_mail(packet) for packet in packets])
+
+def send_batch(messages: list[Message], mail_state: Optional[Any] = None) -> dict[str, str]:
+    """
+    Sends already rendered messages over one connection, reconnecting once if the server drops it part way through
+    A message that fails doesn't stop the rest from being sent
+    :param mail_state: Mail settings to use instead of the app's, from Mail.init_mail()
+    :return: The error for each recipient of a message that couldn't be sent
+    """
+    failures: dict[str, str] = dict()
+    with (Connection(mail_state) if mail_state is not None else mail.connect()) as connection:
+        for msg in messages:
+            try:
+                try:
+                    connection.send(msg)
+                except smtplib.SMTPServerDisconnected:
+                    connection.host = connection.configure_host()
+                    connection.send(msg)
+            except (smtplib.SMTPException, OSError) as e:
+                failures.update({_address(recipient): repr(e) for recipient in msg.send_to})
+    app.logger.info('Sent a batch of {} messages, {} recipients failed'.format(len(messages), len(failures)))
+    return failures
+
 def send_report_mail(form_results: ReportForm, reporter: str) -> None:
     if app.config['MAIL_PROD']:
         recipients = ['<evals@csh.rit.edu>']
@@ -2,18 +2,24 @@
 Defines the application's database models
 """
 
-from datetime import datetime
+from datetime import datetime, timedelta
 from itertools import chain
-from typing import cast, Optional
+from typing import Any, cast, Optional
 
-from sqlalchemy import Column, Integer, String, ForeignKey, DateTime, Boolean
-from sqlalchemy.orm import relationship
+from sqlalchemy import Column, Index, Integer, String, ForeignKey, DateTime, Boolean, JSON, Text, and_, asc, case, \
+    desc, exists, func, literal, or_, select, text
+from sqlalchemy.dialects.postgresql import ARRAY, insert as pg_insert
+from sqlalchemy.orm import relationship, selectinload
+from sqlalchemy.sql.elements import ColumnElement
 
 from . import db
 
 # The required number of honorary member, advisor, and alumni signatures
 REQUIRED_MISC_SIGNATURES = 10
 
+# How old a pending signed notification batch can get before it's assumed its job gave up and a new one is started
+STALE_NOTIFICATION_BATCH = timedelta(days=1)
+
 
 class SigCounts:
     """
@@ -33,6 +39,20 @@ class SigCounts:
         self.total = upper + fresh + self.misc_capped
 
 
+class PacketSummary:
+    """
+    Utility class for the per-packet rows shown on the open packet listings
+    """
+    def __init__(self, packet_id: int, freshman_username: str, freshman_name: str, received: SigCounts,
+                 required: SigCounts, did_sign: bool):
+        self.id = packet_id # pylint: disable=invalid-name
+        self.freshman_username = freshman_username
+        self.freshman_name = freshman_name
+        self.received = received
+        self.required = required
+        self.did_sign = did_sign
+
+
 class Freshman(db.Model):
     __tablename__ = 'freshman'
     rit_username = cast(str, Column(String(10), primary_key=True))
@@ -60,21 +80,33 @@ class Freshman(db.Model):
 
 class Packet(db.Model):
     __tablename__ = 'packet'
+    __table_args__ = (Index('ix_packet_end_start', 'end', 'start'),)
     id = cast(int, Column(Integer, primary_key=True, autoincrement=True))
-    freshman_username = cast(str, Column(ForeignKey('freshman.rit_username')))
+    freshman_username = cast(str, Column(ForeignKey('freshman.rit_username'), index=True))
     start = cast(datetime, Column(DateTime, nullable=False))
     end = cast(datetime, Column(DateTime, nullable=False))
 
+    # Denormalized signature counters, kept in sync with the signature tables on every write
+    # Use `flask recount-signatures` to rebuild them if they ever drift
+    upper_signed = cast(int, Column(Integer, default=0, server_default='0', nullable=False))
+    fresh_signed = cast(int, Column(Integer, default=0, server_default='0', nullable=False))
+    misc_signed = cast(int, Column(Integer, default=0, server_default='0', nullable=False))
+    upper_required = cast(int, Column(Integer, default=0, server_default='0', nullable=False))
+    fresh_required = cast(int, Column(Integer, default=0, server_default='0', nullable=False))
+
+    # Bumped by every write that changes what the packet page shows, so rendered pages can be cached per revision
+    revision = cast(int, Column(Integer, default=0, server_default='0', nullable=False))
+
     freshman = cast(Freshman, relationship('Freshman', back_populates='packets'))
 
-    # The `lazy='subquery'` kwarg enables eager loading for signatures which makes signature calculations much faster
+    # Signatures are lazy loaded by default since most pages only need the counters above
+    # Use `with_signatures=True` on the query helpers to eager load them when a page renders every signature
     # See the docs here for details: https://docs.sqlalchemy.org/en/latest/orm/loading_relationships.html
-    upper_signatures = cast('UpperSignature', relationship('UpperSignature', lazy='subquery',
+    upper_signatures = cast('UpperSignature', relationship('UpperSignature',
                                     order_by='UpperSignature.signed.desc(), UpperSignature.updated'))
-    fresh_signatures = cast('FreshSignature', relationship('FreshSignature', lazy='subquery',
+    fresh_signatures = cast('FreshSignature', relationship('FreshSignature',
                                     order_by='FreshSignature.signed.desc(), FreshSignature.updated'))
-    misc_signatures = cast('MiscSignature',
-            relationship('MiscSignature', lazy='subquery', order_by='MiscSignature.updated'))
+    misc_signatures = cast('MiscSignature', relationship('MiscSignature', order_by='MiscSignature.updated'))
 
     def is_open(self) -> bool:
         return self.start < datetime.now() < self.end
@@ -83,19 +115,13 @@ class Packet(db.Model):
         """
         :return: A SigCounts instance with the fields set to the number of signatures received by this packet
         """
-        upper = len(self.upper_signatures)
-        fresh = len(self.fresh_signatures)
-
-        return SigCounts(upper, fresh, REQUIRED_MISC_SIGNATURES)
+        return SigCounts(self.upper_required, self.fresh_required, REQUIRED_MISC_SIGNATURES)
 
     def signatures_received(self) -> SigCounts:
         """
         :return: A SigCounts instance with the fields set to the number of required signatures for this packet
         """
-        upper = sum(map(lambda sig: 1 if sig.signed else 0, self.upper_signatures))
-        fresh = sum(map(lambda sig: 1 if sig.signed else 0, self.fresh_signatures))
-
-        return SigCounts(upper, fresh, len(self.misc_signatures))
+        return SigCounts(self.upper_signed, self.fresh_signed, self.misc_signed)
 
     def did_sign(self, username: str, is_csh: bool) -> bool:
         """
@@ -116,30 +142,148 @@ class Packet(db.Model):
         # The user must be a misc CSHer that hasn't signed this packet or an off-floor freshmen
         return False
 
-    def is_100(self) -> bool:
+    def has_signed(self, username: str, is_csh: bool) -> bool:
+        """
+        Same as did_sign() but answered with one query instead of loading every signature
+        """
+        return bool(db.session.query(Packet.did_sign_clause(username, is_csh)).filter(Packet.id == self.id).scalar())
+
+    @classmethod
+    def did_sign_clause(cls, username: str, is_csh: bool) -> Any:
+        """
+        :return: A SQL condition that is true for packets the given account signed
+        """
+        if is_csh:
+            return or_(
+                exists().where(and_(UpperSignature.packet_id == cls.id, UpperSignature.member == username,
+                                    UpperSignature.signed)),
+                exists().where(and_(MiscSignature.packet_id == cls.id, MiscSignature.member == username)),
+            )
+        return exists().where(and_(FreshSignature.packet_id == cls.id, FreshSignature.freshman_username == username,
+                                   FreshSignature.signed))
+
+    @classmethod
+    def open_clause(cls, packet_id: int) -> Any:
+        """
+        :return: A SQL condition that is true while the given packet is open
+        """
+        return exists().where(and_(cls.id == packet_id, cls.start < datetime.now(), cls.end > datetime.now()))
+
+    @classmethod
+    def add_signed(cls, packet_id: int, kind: str) -> tuple[SigCounts, SigCounts, bool]:
+        """
+        Atomically increments one of the signed counters of a packet
+        Concurrent signatures are serialized on the packet row, so exactly one of them will see the packet reach 100%
+        :param kind: The type of signature to count, one of 'upper', 'fresh', or 'misc'
+        :return: The received and required SigCounts after the increment, and whether this signature brought the
+                 packet to 100%
+        """
+        table = cls.__table__
+        upper, fresh, misc, upper_required, fresh_required = db.session.execute(
+            table.update()
+            .where(table.c.id == packet_id)
+            .values({kind + '_signed': table.c[kind + '_signed'] + 1, 'revision': table.c.revision + 1})
+            .returning(table.c.upper_signed, table.c.fresh_signed, table.c.misc_signed, table.c.upper_required,
+                       table.c.fresh_required)
+        ).one()
+
+        signed = {'upper': upper, 'fresh': fresh, 'misc': misc}
+        received = SigCounts(**signed)
+        required = SigCounts(upper_required, fresh_required, REQUIRED_MISC_SIGNATURES)
+        before = SigCounts(**{**signed, kind: signed[kind] - 1})
+
+        return received, required, before.total < required.total == received.total
+
+    @classmethod
+    def signature_loaders(cls) -> tuple:
+        """
+        :return: Query options that eager load all of a packet's signatures
+        """
+        return selectinload(cls.upper_signatures), selectinload(cls.fresh_signatures), \
+            selectinload(cls.misc_signatures)
+
+    @classmethod
+    def open_revision(cls) -> tuple[int, int, int]:
         """
-        Checks if this packet has reached 100%
+        :return: A value that changes whenever a packet opens or closes or an open packet changes, for pages built from
+                 every open packet
         """
-        return self.signatures_required().total == self.signatures_received().total
+        return db.session.query(func.count(cls.id), func.coalesce(func.sum(cls.id), 0),
+                                func.coalesce(func.sum(cls.revision), 0)) \
+            .filter(cls.start < datetime.now(), cls.end > datetime.now()) \
+            .one()
 
     @classmethod
-    def open_packets(cls) -> list['Packet']:
+    def open_summaries(cls, username: str, is_csh: bool, reverse: bool = False) -> list[PacketSummary]:
         """
-        Helper method for fetching all currently open packets
+        Fetches one summary row per open packet in a single query, sorted by freshman name, then signatures received,
+        then whether the given account signed
+        :param username: The CSH or RIT username to check signatures for
+        :param is_csh: Set to True for CSH accounts and False for freshmen
+        :param reverse: Reverses the sort order
         """
-        return cls.query.filter(cls.start < datetime.now(), cls.end > datetime.now()).all()
+        misc_capped: ColumnElement[Integer] = case(
+            (cls.misc_signed > REQUIRED_MISC_SIGNATURES, REQUIRED_MISC_SIGNATURES), else_=cls.misc_signed)
+        received_total = (cls.upper_signed + cls.fresh_signed + misc_capped).label('received_total')
+        did_sign = cls.did_sign_clause(username, is_csh).label('did_sign')
+
+        if reverse:
+            order_by = [desc(Freshman.name), asc(received_total), asc(did_sign)]
+        else:
+            order_by = [asc(Freshman.name), desc(received_total), desc(did_sign)]
+
+        rows = db.session.query(cls.id, cls.freshman_username, Freshman.name, cls.upper_signed, cls.fresh_signed,
+                                cls.misc_signed, cls.upper_required, cls.fresh_required, did_sign, received_total) \
+            .join(Freshman, cls.freshman_username == Freshman.rit_username) \
+            .filter(cls.start < datetime.now(), cls.end > datetime.now()) \
+            .order_by(*order_by) \
+            .all()
+
+        return [PacketSummary(packet_id, freshman_username, name,
+                              SigCounts(upper_signed, fresh_signed, misc_signed),
+                              SigCounts(upper_required, fresh_required, REQUIRED_MISC_SIGNATURES),
+                              bool(signed))
+                for packet_id, freshman_username, name, upper_signed, fresh_signed, misc_signed, upper_required,
+                    fresh_required, signed, _ in rows]
 
     @classmethod
-    def by_id(cls, packet_id: int) -> 'Packet':
+    def by_id(cls, packet_id: int, with_signatures: bool = False) -> 'Packet':
         """
         Helper method for fetching 1 packet by its id
+        :param with_signatures: Set to True to eager load the packet's signatures
+        """
+        query = cls.query.filter_by(id=packet_id)
+        if with_signatures:
+            query = query.options(*cls.signature_loaders())
+        return query.first()
+
+    @classmethod
+    def recount_signatures(cls, *criterion: Any) -> int:
+        """
+        Recomputes the denormalized signature counters from the signature tables with a single UPDATE, and bumps the
+        revision of each packet since its signatures were presumably just changed
+        :param criterion: Optional filters limiting which packets get recounted, defaults to every packet
+        :return: The number of packets updated
         """
-        return cls.query.filter_by(id=packet_id).first()
+        def count(model: Any, *where: Any) -> Any:
+            return select(func.count()).select_from(model).where(model.packet_id == cls.id, *where).scalar_subquery()
+
+        db.session.flush()
+        return cls.query.filter(*criterion).update({
+            cls.upper_signed: count(UpperSignature, UpperSignature.signed),
+            cls.fresh_signed: count(FreshSignature, FreshSignature.signed),
+            cls.misc_signed: count(MiscSignature),
+            cls.upper_required: count(UpperSignature),
+            cls.fresh_required: count(FreshSignature),
+            cls.revision: cls.revision + 1,
+        }, synchronize_session='fetch')
+
 
 class UpperSignature(db.Model):
     __tablename__ = 'signature_upper'
+    __table_args__ = (Index('ix_signature_upper_signed', 'packet_id', postgresql_where=text('signed')),)
     packet_id = cast(int, Column(Integer, ForeignKey('packet.id'), primary_key=True))
-    member = cast(str, Column(String(36), primary_key=True))
+    member = cast(str, Column(String(36), primary_key=True, index=True))
     signed = cast(bool, Column(Boolean, default=False, nullable=False))
     eboard = cast(Optional[str], Column(String(12), nullable=True))
     active_rtp = cast(bool, Column(Boolean, default=False, nullable=False))
@@ -152,29 +296,165 @@ class UpperSignature(db.Model):
 
     packet = cast(Packet, relationship('Packet', back_populates='upper_signatures'))
 
+    @classmethod
+    def sign(cls, packet_id: int, member: str) -> bool:
+        """
+        Signs the member's row on the given packet with a single conditional UPDATE
+        :return: True if the packet is open and the row went from unsigned to signed
+        """
+        table = cls.__table__
+        return db.session.execute(
+            table.update()
+            .where(table.c.packet_id == packet_id, table.c.member == member, ~table.c.signed,
+                   Packet.open_clause(packet_id))
+            .values(signed=True)
+        ).rowcount == 1
+
 
 class FreshSignature(db.Model):
     __tablename__ = 'signature_fresh'
+    __table_args__ = (Index('ix_signature_fresh_signed', 'packet_id', postgresql_where=text('signed')),)
     packet_id = cast(int, Column(Integer, ForeignKey('packet.id'), primary_key=True))
-    freshman_username = cast(str, Column(ForeignKey('freshman.rit_username'), primary_key=True))
+    freshman_username = cast(str, Column(ForeignKey('freshman.rit_username'), primary_key=True, index=True))
     signed = cast(bool, Column(Boolean, default=False, nullable=False))
     updated = cast(datetime, Column(DateTime, default=datetime.now, onupdate=datetime.now, nullable=False))
 
     packet = cast(Packet, relationship('Packet', back_populates='fresh_signatures'))
     freshman = cast(Freshman, relationship('Freshman', back_populates='fresh_signatures'))
 
+    @classmethod
+    def sign(cls, packet_id: int, freshman_username: str) -> bool:
+        """
+        Signs the freshman's row on the given packet with a single conditional UPDATE
+        :return: True if the packet is open and the row went from unsigned to signed
+        """
+        table = cls.__table__
+        return db.session.execute(
+            table.update()
+            .where(table.c.packet_id == packet_id, table.c.freshman_username == freshman_username, ~table.c.signed,
+                   Packet.open_clause(packet_id))
+            .values(signed=True)
+        ).rowcount == 1
+
 
 class MiscSignature(db.Model):
     __tablename__ = 'signature_misc'
     packet_id = cast(int, Column(Integer, ForeignKey('packet.id'), primary_key=True))
-    member = cast(str, Column(String(36), primary_key=True))
+    member = cast(str, Column(String(36), primary_key=True, index=True))
     updated = cast(datetime, Column(DateTime, default=datetime.now, onupdate=datetime.now, nullable=False))
 
     packet = cast(Packet, relationship('Packet', back_populates='misc_signatures'))
 
+    @classmethod
+    def sign(cls, packet_id: int, member: str) -> bool:
+        """
+        Adds a misc signature for the member with an idempotent INSERT
+        :return: True if the packet is open, the member doesn't have an upperclassmen row, and the row was created
+        """
+        signable = select(literal(packet_id), literal(member), literal(datetime.now())) \
+            .where(Packet.open_clause(packet_id),
+                   ~exists().where(and_(UpperSignature.packet_id == packet_id, UpperSignature.member == member)))
+        return db.session.execute(
+            pg_insert(cls.__table__)
+            .from_select(['packet_id', 'member', 'updated'], signable)
+            .on_conflict_do_nothing()
+        ).rowcount == 1
+
 
 class NotificationSubscription(db.Model):
     __tablename__ = 'notification_subscriptions'
-    member = cast(str, Column(String(36), nullable=True))
-    freshman_username = cast(str, Column(ForeignKey('freshman.rit_username'), nullable=True))
+    member = cast(str, Column(String(36), nullable=True, index=True))
+    freshman_username = cast(str, Column(ForeignKey('freshman.rit_username'), nullable=True, index=True))
     token = cast(str, Column(String(256), primary_key=True, nullable=False))
+
+    @classmethod
+    def subscribe(cls, token: str, member: Optional[str] = None, freshman_username: Optional[str] = None) -> None:
+        """
+        Subscribes the token for the given member or freshman, taking the token over if it's already subscribed
+        """
+        stmt = pg_insert(cls.__table__).values(token=token, member=member, freshman_username=freshman_username)
+        db.session.execute(stmt.on_conflict_do_update(index_elements=['token'], set_={
+                'member': stmt.excluded.member,
+                'freshman_username': stmt.excluded.freshman_username,
+                }))
+
+
+class SignedNotificationBatch(db.Model):
+    """
+    The signers of a packet waiting to be sent to its freshman as one "signed your packet" notification
+    """
+    __tablename__ = 'signed_notification_batch'
+    packet_id = cast(int, Column(ForeignKey('packet.id'), primary_key=True))
+    signers = cast(list, Column(ARRAY(String(36)), nullable=False))
+    created = cast(datetime, Column(DateTime, default=datetime.now, nullable=False))
+
+    @classmethod
+    def add(cls, packet_id: int, signer: str) -> bool:
+        """
+        Adds a signer to the packet's pending batch in one statement, so concurrent signatures all land in one batch
+        :return: Whether this started a new batch, meaning a job needs to be queued to send it
+        """
+        now = datetime.now()
+        stmt = pg_insert(cls.__table__).values(packet_id=packet_id, signers=[signer], created=now)
+        stale = cls.created < now - STALE_NOTIFICATION_BATCH
+        merged = func.array_cat(cls.signers, stmt.excluded.signers)
+        stmt = stmt.on_conflict_do_update(index_elements=['packet_id'], set_={
+                'signers': case((stale, stmt.excluded.signers), else_=merged),
+                'created': case((stale, stmt.excluded.created), else_=cls.created),
+                })
+        return db.session.execute(stmt.returning(func.cardinality(cls.signers))).scalar() == 1
+
+    @classmethod
+    def take(cls, packet_id: int) -> list[str]:
+        """
+        Removes the packet's pending batch in its own transaction, so signers starting the next batch don't wait on this
+        one being sent
+        :return: The batch's signers in the order they signed
+        """
+        with db.engine.begin() as connection:
+            signers = connection.execute(
+                cls.__table__.delete().where(cls.packet_id == packet_id).returning(cls.signers)
+            ).scalar()
+        return signers or []
+
+    @classmethod
+    def restore(cls, packet_id: int, signers: list[str]) -> None:
+        """
+        Puts signers that were taken but couldn't be notified back in front of the packet's pending batch, in its own
+        transaction so it isn't rolled back along with the failed job
+        """
+        stmt = pg_insert(cls.__table__).values(packet_id=packet_id, signers=signers, created=datetime.now())
+        stmt = stmt.on_conflict_do_update(index_elements=['packet_id'], set_={
+                'signers': func.array_cat(stmt.excluded.signers, cls.signers),
+                })
+        with db.engine.begin() as connection:
+            connection.execute(stmt)
+
+
+class Avatar(db.Model):
+    __tablename__ = 'avatar'
+    username = cast(str, Column(String(36), primary_key=True))
+    url = cast(str, Column(String(256), nullable=False))
+    checked = cast(datetime, Column(DateTime, default=datetime.now, nullable=False))
+
+    @classmethod
+    def store(cls, username: str, url: str) -> None:
+        stmt = pg_insert(cls.__table__).values(username=username, url=url, checked=datetime.now())
+        db.session.execute(stmt.on_conflict_do_update(index_elements=['username'], set_={
+                'url': stmt.excluded.url,
+                'checked': stmt.excluded.checked,
+                }))
+
+
+class Job(db.Model):
+    """
+    A unit of background work, written in the same transaction as the change that caused it and run by the worker
+    """
+    __tablename__ = 'job'
+    id = cast(int, Column(Integer, primary_key=True, autoincrement=True))
+    kind = cast(str, Column(String(64), nullable=False))
+    payload = cast(dict, Column(JSON, nullable=False))
+    attempts = cast(int, Column(Integer, default=0, server_default='0', nullable=False))
+    run_after = cast(datetime, Column(DateTime, default=datetime.now, nullable=False, index=True))
+    created = cast(datetime, Column(DateTime, default=datetime.now, nullable=False))
+    last_error = cast(Optional[str], Column(Text, nullable=True))
@@ -1,18 +1,20 @@
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from typing import Any, Callable, TypeVar, cast
+from typing import Any, Callable, Iterable, Optional, TypeVar, cast
 
 import onesignal
+import requests
 
 from packet import app, intro_onesignal_client, csh_onesignal_client
 from packet.models import NotificationSubscription, Packet
 
-post_body = {
-    'contents': {'en': 'Default message'},
-    'headings': {'en': 'Default Title'},
-    'chrome_web_icon': app.config['PROTOCOL'] + app.config['SERVER_NAME'] + '/static/android-chrome-512x512.png',
-    'chrome_web_badge': app.config['PROTOCOL'] + app.config['SERVER_NAME'] + '/static/android-chrome-512x512.png',
-    'url': app.config['PROTOCOL'] + app.config['SERVER_NAME']
-}
+# The most player ids OneSignal accepts in a single notification
+MAX_PLAYER_IDS = 2000
+
+# Shared by every fan-out so the number of requests in flight to OneSignal stays bounded, it lives as long as the
+# process so it's never shut down
+_send_pool = ThreadPoolExecutor(  # pylint: disable=consider-using-with
+    max_workers=app.config['ONESIGNAL_MAX_CONCURRENCY'], thread_name_prefix='onesignal')
 
 WrappedFunc = TypeVar('WrappedFunc', bound=Callable)
 
@@ -31,68 +33,151 @@ def require_onesignal_csh(func: WrappedFunc) -> WrappedFunc:
     return cast(WrappedFunc, require_onesignal_csh_wrapper)
 
 
-def send_notification(notification_body: dict, subscriptions: list, client: onesignal.Client) -> None:
-    tokens = list(map(lambda subscription: subscription.token, subscriptions))
-    if tokens:
-        notification = onesignal.Notification(post_body=notification_body)
-        notification.post_body['include_player_ids'] = tokens
-        onesignal_response = client.send_notification(notification)
-        if onesignal_response.status_code == 200:
-            app.logger.info('The notification ({}) sent out successfully'.format(notification.post_body))
-        else:
-            app.logger.warn('The notification ({}) was unsuccessful'.format(notification.post_body))
+def notification_body(heading: str, contents: str, **extra: str) -> dict:
+    """
+    Builds a new notification body, any extra fields override the defaults
+    """
+    icon = app.config['PROTOCOL'] + app.config['SERVER_NAME'] + '/static/android-chrome-512x512.png'
+    return {
+        'contents': {'en': contents},
+        'headings': {'en': heading},
+        'chrome_web_icon': icon,
+        'chrome_web_badge': icon,
+        'url': app.config['PROTOCOL'] + app.config['SERVER_NAME'],
+        **extra,
+    }
+
+
+def _send_chunk(body: dict, tokens: list[str], client: onesignal.Client) -> list[str]:
+    """
+    Sends a notification to one chunk of tokens
+    :return: The tokens OneSignal reported as no longer subscribed
+    """
+    response = client.send_notification(onesignal.Notification(post_body={**body, 'include_player_ids': tokens}))
+    if response.status_code != 200:
+        raise onesignal.OneSignalError('OneSignal responded {}: {}'.format(response.status_code, response.text))
+
+    errors = response.json().get('errors')
+    if isinstance(errors, dict):
+        return list(errors.get('invalid_player_ids', []))
+    if isinstance(errors, list) and 'All included players are not subscribed' in errors:
+        return tokens
+    return []
+
+
+def send_notification(body: dict, subscriptions: Iterable[NotificationSubscription],
+                      client: onesignal.Client) -> None:
+    """
+    Sends a notification to the given subscriptions in chunks of MAX_PLAYER_IDS, several chunks at a time
+    Tokens OneSignal says are no longer subscribed are deleted, the caller is responsible for committing
+    Raises the first error if every chunk failed so the job is retried, partial failures are only logged since a retry
+    would send duplicates to the chunks that succeeded
+    """
+    tokens = [subscription.token for subscription in subscriptions]
+    chunks = [tokens[i:i + MAX_PLAYER_IDS] for i in range(0, len(tokens), MAX_PLAYER_IDS)]
+    futures = [_send_pool.submit(_send_chunk, body, chunk, client) for chunk in chunks]
+
+    invalid: list[str] = []
+    errors: list[Exception] = []
+    for chunk, future in zip(chunks, futures):
+        try:
+            invalid.extend(future.result())
+        except Exception as e:  # pylint: disable=broad-except
+            app.logger.warn('The notification ({}) failed for {} tokens: {!r}'.format(body['headings'], len(chunk), e))
+            errors.append(e)
+    if errors and len(errors) == len(chunks):
+        raise errors[0]
+
+    if invalid:
+        NotificationSubscription.query \
+            .filter(cast(Any, NotificationSubscription.token).in_(invalid)) \
+            .delete(synchronize_session=False)
+        app.logger.info('Removed {} unsubscribed notification tokens'.format(len(invalid)))
+    app.logger.info('The notification ({}) sent out to {} tokens'.format(body['headings'], len(tokens) - len(invalid)))
+
+
+def signed_message(signers: list[str]) -> str:
+    """
+    :return: The notification text for a batch of signers, like "a, b and 5 others signed your packet!"
+    """
+    if len(signers) == 1:
+        return signers[0] + ' signed your packet!'
+    if len(signers) <= 3:
+        return ', '.join(signers[:-1]) + ' and ' + signers[-1] + ' signed your packet!'
+    return '{}, {} and {} others signed your packet!'.format(signers[0], signers[1], len(signers) - 2)
+
+
+def _member_subscriptions() -> list[NotificationSubscription]:
+    return NotificationSubscription.query.filter(cast(Any, NotificationSubscription.member).isnot(None)).all()
+
+
+def _freshman_subscriptions(freshman_username: Optional[str] = None) -> list[NotificationSubscription]:
+    if freshman_username is not None:
+        return NotificationSubscription.query.filter_by(freshman_username=freshman_username).all()
+    return NotificationSubscription.query \
+        .filter(cast(Any, NotificationSubscription.freshman_username).isnot(None)) \
+        .all()
 
 
 @require_onesignal_intro
-def packet_signed_notification(packet: Packet, signer: str) -> None:
-    subscriptions = NotificationSubscription.query.filter_by(freshman_username=packet.freshman_username)
+def packet_signed_notification(packet: Packet, signers: list[str]) -> None:
+    subscriptions = _freshman_subscriptions(packet.freshman_username)
+    if subscriptions:
+        body = notification_body('New Packet Signature!' if len(signers) == 1 else 'New Packet Signatures!',
+                                 signed_message(signers),
+                                 chrome_web_icon='https://profiles.csh.rit.edu/image/' + signers[0],
+                                 url=app.config['PROTOCOL'] + app.config['PACKET_INTRO'])
+
+        send_notification(body, subscriptions, intro_onesignal_client)
+
+
+def packet_100_percent_notification(packet: Packet, realm: str) -> None:
+    """
+    Tells the members or the freshmen that the packet reached 100%, each realm is sent separately so a failure sending
+    to one doesn't send the other a duplicate when it's retried
+    :param realm: 'csh' to notify members or 'intro' to notify freshmen
+    """
+    client = csh_onesignal_client if realm == 'csh' else intro_onesignal_client
+    if client is None:
+        return
+    subscriptions = _member_subscriptions() if realm == 'csh' else _freshman_subscriptions()
     if subscriptions:
-        notification_body = post_body
-        notification_body['contents']['en'] = signer + ' signed your packet!'
-        notification_body['headings']['en'] = 'New Packet Signature!'
-        notification_body['chrome_web_icon'] = 'https://profiles.csh.rit.edu/image/' + signer
-        notification_body['url'] = app.config['PROTOCOL'] + app.config['PACKET_INTRO']
-
-        send_notification(notification_body, subscriptions, intro_onesignal_client)
-
-
-@require_onesignal_csh
-@require_onesignal_intro
-def packet_100_percent_notification(packet: Packet) -> None:
-    member_subscriptions = NotificationSubscription.query.filter(cast(Any, NotificationSubscription.member).isnot(None))
-    intro_subscriptions = NotificationSubscription.query.filter(
-            cast(Any, NotificationSubscription.freshman_username).isnot(None))
-    if member_subscriptions or intro_subscriptions:
-        notification_body = post_body
-        notification_body['contents']['en'] = packet.freshman.name + ' got 💯 on packet!'
-        notification_body['headings']['en'] = 'New 100% on Packet!'
         # TODO: Issue #156
-        notification_body['chrome_web_icon'] = 'https://profiles.csh.rit.edu/image/' + packet.freshman_username
+        body = notification_body('New 100% on Packet!', packet.freshman.name + ' got 💯 on packet!',
+                                 chrome_web_icon='https://profiles.csh.rit.edu/image/' + packet.freshman_username)
 
-        send_notification(notification_body, member_subscriptions, csh_onesignal_client)
-        send_notification(notification_body, intro_subscriptions, intro_onesignal_client)
+        send_notification(body, subscriptions, client)
 
 
 @require_onesignal_intro
 def packet_starting_notification(packet: Packet) -> None:
-    subscriptions = NotificationSubscription.query.filter_by(freshman_username=packet.freshman_username)
+    subscriptions = _freshman_subscriptions(packet.freshman_username)
     if subscriptions:
-        notification_body = post_body
-        notification_body['contents']['en'] = 'Log into your packet, and get started meeting people!'
-        notification_body['headings']['en'] = 'Your packet has begun!'
-        notification_body['url'] = app.config['PROTOCOL'] + app.config['PACKET_INTRO']
-        notification_body['send_after'] = packet.start.strftime('%Y-%m-%d %H:%M:%S')
+        body = notification_body('Your packet has begun!', 'Log into your packet, and get started meeting people!',
+                                 url=app.config['PROTOCOL'] + app.config['PACKET_INTRO'],
+                                 send_after=packet.start.strftime('%Y-%m-%d %H:%M:%S'))
 
-        send_notification(notification_body, subscriptions, intro_onesignal_client)
+        send_notification(body, subscriptions, intro_onesignal_client)
 
 
 @require_onesignal_csh
 def packets_starting_notification(start_date: datetime) -> None:
-    member_subscriptions = NotificationSubscription.query.filter(cast(Any, NotificationSubscription.member).isnot(None))
+    member_subscriptions = _member_subscriptions()
     if member_subscriptions:
-        notification_body = post_body
-        notification_body['contents']['en'] = 'New packets have started, visit packet to see them!'
-        notification_body['headings']['en'] = 'Packets Start Today!'
-        notification_body['send_after'] = start_date.strftime('%Y-%m-%d %H:%M:%S')
+        body = notification_body('Packets Start Today!', 'New packets have started, visit packet to see them!',
+                                 send_after=start_date.strftime('%Y-%m-%d %H:%M:%S'))
+
+        send_notification(body, member_subscriptions, csh_onesignal_client)
+
+
+def notify_slack(name: str) -> None:
+    """
+    Sends a congratulate on sight decree to Slack
+    """
+    if app.config['SLACK_WEBHOOK_URL'] is None:
+        app.logger.warn('SLACK_WEBHOOK_URL not configured, not sending message to slack.')
+        return
 
-        send_notification(notification_body, member_subscriptions, csh_onesignal_client)
+    msg = f':pizza-party: {name} got :100: on packet! :pizza-party:'
+    requests.put(app.config['SLACK_WEBHOOK_URL'], json={'text': msg}, timeout=10).raise_for_status()
+    app.logger.info('Posted 100% notification to slack for ' + name)
@@ -3,7 +3,6 @@ from flask import render_template
 
 from packet import app
 from packet.models import Packet, Freshman
-from packet.routes.shared import packet_sort_key
 from packet.utils import before_request, packet_auth, admin_auth
 from packet.log_utils import log_cache, log_time
 
@@ -15,15 +14,7 @@ from packet.log_utils import log_cache, log_time
 @before_request
 @log_time
 def admin_packets(info: Dict[str, Any]) -> str:
-    open_packets = Packet.open_packets()
-
-    # Pre-calculate and store the return values of did_sign(), signatures_received(), and signatures_required()
-    for packet in open_packets:
-        packet.did_sign_result = packet.did_sign(info['uid'], app.config['REALM'] == 'csh')
-        packet.signatures_received_result = packet.signatures_received()
-        packet.signatures_required_result = packet.signatures_required()
-
-    open_packets.sort(key=packet_sort_key, reverse=True)
+    open_packets = Packet.open_summaries(info['uid'], app.config['REALM'] == 'csh', reverse=True)
 
     return render_template('admin_packets.html',
                            open_packets=open_packets,
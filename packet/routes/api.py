@@ -3,18 +3,18 @@ Shared API endpoints
 """
 from datetime import datetime
 from json import dumps
-from typing import Dict, Any, Union, Tuple
+from typing import Dict, Any, Optional, Union, Tuple
 
-from flask import session, request
+from flask import Response, jsonify, request
 
-from packet import app, db, ldap
-from packet.context_processors import get_rit_name
+from packet import app, db
+from packet.context_processors import get_csh_name, get_rit_name
+from packet.events import event_stream, publish, signature_event, signature_visible_to
 from packet.log_utils import log_time
-from packet.mail import send_report_mail
-from packet.utils import before_request, packet_auth, notify_slack, sync_freshman as sync_freshman_list, \
-    create_new_packets, sync_with_ldap
-from packet.models import Packet, MiscSignature, NotificationSubscription, Freshman
-from packet.notifications import packet_signed_notification, packet_100_percent_notification
+from packet.jobs import enqueue, enqueue_100_percent_notifications, enqueue_signed_notification
+from packet.utils import before_request, conditional_response, current_identity, packet_auth, \
+    sync_freshman as sync_freshman_list, create_new_packets, sync_with_ldap
+from packet.models import Packet, MiscSignature, NotificationSubscription, Freshman, UpperSignature, FreshSignature
 import packet.stats as stats
 
 
@@ -41,15 +41,14 @@ def sync_freshman() -> Tuple[str, int]:
     """
 
     # Only allow evals to create new frosh
-    username: str = str(session['userinfo'].get('preferred_username', ''))
-    if not ldap.is_evals(ldap.get_member(username)):
+    if not current_identity().evals:
         return 'Forbidden: not Evaluations Director', 403
 
     freshmen_in_post: Dict[str, POSTFreshman] = {
         freshman.rit_username: freshman for freshman in map(POSTFreshman, request.json)
     }
-    sync_freshman_list(freshmen_in_post)
-    return dumps('Done'), 200
+    summary = sync_freshman_list(freshmen_in_post)
+    return dumps(summary), 200
 
 
 @app.route('/api/v1/packets', methods=['POST'])
@@ -72,8 +71,7 @@ def create_packet() -> Tuple[str, int]:
     """
 
     # Only allow evals to create new packets
-    username: str = str(session['userinfo'].get('preferred_username', ''))
-    if not ldap.is_evals(ldap.get_member(username)):
+    if not current_identity().evals:
         return 'Forbidden: not Evaluations Director', 403
 
     base_date: datetime = datetime.strptime(request.json['start_date'], '%m/%d/%Y %H')
@@ -82,9 +80,9 @@ def create_packet() -> Tuple[str, int]:
         freshman.rit_username: freshman for freshman in map(POSTFreshman, request.json['freshmen'])
     }
 
-    create_new_packets(base_date, freshmen_in_post)
+    summary = create_new_packets(base_date, freshmen_in_post)
 
-    return dumps('Done'), 201
+    return dumps(summary), 201
 
 
 @app.route('/api/v1/sync', methods=['POST'])
@@ -92,11 +90,10 @@ def create_packet() -> Tuple[str, int]:
 @log_time
 def sync_ldap() -> Tuple[str, int]:
     # Only allow evals to sync ldap
-    username: str = str(session['userinfo'].get('preferred_username', ''))
-    if not ldap.is_evals(ldap.get_member(username)):
+    if not current_identity().evals:
         return 'Forbidden: not Evaluations Director', 403
-    sync_with_ldap()
-    return dumps('Done'), 201
+    summary = sync_with_ldap()
+    return dumps(summary), 201
 
 
 @app.route('/api/v1/packets/<username>', methods=['GET'])
@@ -120,7 +117,7 @@ def get_packets_by_user(username: str, info: Dict[str, Any]) -> Union[Dict[int,
 @app.route('/api/v1/packets/<username>/newest', methods=['GET'])
 @packet_auth
 @before_request
-def get_newest_packet_by_user(username: str, info: Dict[str, Any]) -> Union[Dict[int, Dict[str, Any]], Tuple[str, int]]:
+def get_newest_packet_by_user(username: str, info: Dict[str, Any]) -> Union[Response, Tuple[str, int]]:
     """
     Return a user's newest packet
     """
@@ -132,63 +129,64 @@ def get_newest_packet_by_user(username: str, info: Dict[str, Any]) -> Union[Dict
 
     packet: Packet = frosh.packets[-1]
 
-    return {
+    return conditional_response(lambda: {
         packet.id: {
             'start': packet.start,
             'end': packet.end,
             'required': vars(packet.signatures_required()),
             'received': vars(packet.signatures_received()),
         }
-    }
+    }, packet.id, packet.revision, packet.start, packet.end)
 
 
 @app.route('/api/v1/packet/<int:packet_id>', methods=['GET'])
 @packet_auth
 @before_request
-def get_packet_by_id(packet_id: int, info: Dict[str, Any]) -> Union[Dict[str, Dict[str, Any]], Tuple[str, int]]:
+def get_packet_by_id(packet_id: int, info: Dict[str, Any]) -> Union[Response, Tuple[str, int]]:
     """
     Return the scores of the packet in question
     """
 
     packet: Packet = Packet.by_id(packet_id)
 
-    if not info['is_upper'] and info['ritdn'] != packet.freshman.rit_username:
+    if not info['is_upper'] and info['ritdn'] != packet.freshman_username:
         return 'Forbidden - not your packet', 403
 
-    return {
+    return conditional_response(lambda: {
         'required': vars(packet.signatures_required()),
         'received': vars(packet.signatures_received()),
-    }
+    }, packet.id, packet.revision)
 
 
 @app.route('/api/v1/sign/<int:packet_id>/', methods=['POST'])
 @packet_auth
 @before_request
-def sign(packet_id: int, info: Dict[str, Any]) -> str:
-    packet: Packet = Packet.by_id(packet_id)
+def sign(packet_id: int, info: Dict[str, Any]) -> Union[str, Response, Tuple[Response, int]]:
+    """
+    Signs the packet as the logged in user
+    Clients that accept application/json get the signature and the packet's new counts back in the same form as the
+    events streamed to the packet pages, with 'own' set and 'reached_100' set if this signature completed the packet
+    """
+    if app.config['REALM'] == 'csh':
+        # Check if the CSHer is an upperclassman and if so, sign that row
+        if UpperSignature.sign(packet_id, info['uid']):
+            app.logger.info('Member {} signed packet {} as an upperclassman'.format(info['uid'], packet_id))
+            return commit_sig(packet_id, 'upper', info['uid'])
 
-    if packet is not None and packet.is_open():
-        was_100: bool = packet.is_100()
-        if app.config['REALM'] == 'csh':
-            # Check if the CSHer is an upperclassman and if so, sign that row
-            for sig in filter(lambda sig: sig.member == info['uid'], packet.upper_signatures):
-                sig.signed = True
-                app.logger.info('Member {} signed packet {} as an upperclassman'.format(info['uid'], packet_id))
-                return commit_sig(packet, was_100, info['uid'])
-
-            # The CSHer is a misc so add a new row
-            db.session.add(MiscSignature(packet=packet, member=info['uid']))
+        # The CSHer is a misc so add a new row
+        if MiscSignature.sign(packet_id, info['uid']):
             app.logger.info('Member {} signed packet {} as a misc'.format(info['uid'], packet_id))
-            return commit_sig(packet, was_100, info['uid'])
-        else:
-            # Check if the freshman is onfloor and if so, sign that row
-            for sig in filter(lambda sig: sig.freshman_username == info['uid'], packet.fresh_signatures):
-                sig.signed = True
-                app.logger.info('Freshman {} signed packet {}'.format(info['uid'], packet_id))
-                return commit_sig(packet, was_100, info['uid'])
+            return commit_sig(packet_id, 'misc', info['uid'])
+    else:
+        # Check if the freshman is onfloor and if so, sign that row
+        if FreshSignature.sign(packet_id, info['uid']):
+            app.logger.info('Freshman {} signed packet {}'.format(info['uid'], packet_id))
+            return commit_sig(packet_id, 'fresh', info['uid'])
 
-    app.logger.warn("Failed to add {}'s signature to packet {}".format(info['uid'], packet_id))
-    return 'Error: Signature not valid.  Reason: Unknown'
+    # Nothing was signed, which is fine if the user had already signed this packet
+    db.session.rollback()
+    response = _already_signed(packet_id, info['uid'])
+    return response if response is not None else _sign_failed(packet_id, info['uid'])
 
 
 @app.route('/api/v1/subscribe/', methods=['POST'])
@@ -196,12 +194,10 @@ def sign(packet_id: int, info: Dict[str, Any]) -> str:
 @before_request
 def subscribe(info: Dict[str, Any]) -> str:
     data = request.form
-    subscription: NotificationSubscription
     if app.config['REALM'] == 'csh':
-        subscription = NotificationSubscription(token=data['token'], member=info['uid'])
+        NotificationSubscription.subscribe(data['token'], member=info['uid'])
     else:
-        subscription = NotificationSubscription(token=data['token'], freshman_username=info['uid'])
-    db.session.add(subscription)
+        NotificationSubscription.subscribe(data['token'], freshman_username=info['uid'])
     db.session.commit()
     return 'Token subscribed for ' + info['uid']
 
@@ -211,27 +207,72 @@ def subscribe(info: Dict[str, Any]) -> str:
 @before_request
 def report(info: Dict[str, Any]) -> str:
     form_results = request.form
-    send_report_mail(form_results, get_rit_name(info['uid']))
+    enqueue('report_mail', person=form_results['person'], report=form_results['report'],
+            reporter=get_rit_name(info['uid']))
+    db.session.commit()
     return 'Success: ' + get_rit_name(info['uid']) + ' sent a report'
 
 
 @app.route('/api/v1/stats/packet/<int:packet_id>')
 @packet_auth
 @before_request
-def packet_stats(packet_id: int, info: Dict[str, Any]) -> Union[stats.PacketStats, Tuple[str, int]]:
-    if not info['is_upper'] and info['ritdn'] != Packet.by_id(packet_id).freshman.rit_username:
+def packet_stats(packet_id: int, info: Dict[str, Any]) -> Union[Response, Tuple[str, int]]:
+    packet = Packet.by_id(packet_id)
+    if packet is None:
+        return 'Packet not found', 404
+    if not info['is_upper'] and info['ritdn'] != packet.freshman_username:
         return 'Forbidden - not your packet', 403
-    return stats.packet_stats(packet_id)
+    return conditional_response(lambda: stats.packet_stats(packet_id, with_uids=True), packet.id, packet.revision,
+                                packet.start, packet.end)
 
 
 @app.route('/api/v1/stats/upperclassman/<uid>')
 @packet_auth
 @before_request
-def upperclassman_stats(uid: str, info: Dict[str, Any]) -> Union[stats.UpperStats, Tuple[str, int]]:
+def upperclassman_stats(uid: str, info: Dict[str, Any]) -> Union[Response, Tuple[str, int]]:
+    if not info['is_upper']:
+        return 'Forbidden', 403
+
+    count, last_change = stats.upperclassman_last_change(uid)
+    return conditional_response(lambda: stats.upperclassman_stats(uid), count, last_change, last_modified=last_change)
+
+
+@app.route('/api/v1/stats/upperclassmen')
+@packet_auth
+@before_request
+def upperclassmen_totals(info: Dict[str, Any]) -> Union[Response, Tuple[str, int]]:
     if not info['is_upper']:
         return 'Forbidden', 403
 
-    return stats.upperclassman_stats(uid)
+    return conditional_response(stats.upperclassmen_totals, Packet.open_revision())
+
+
+@app.route('/api/v1/stream/packet/<int:packet_id>')
+@packet_auth
+@before_request
+def stream_packet(packet_id: int, info: Dict[str, Any]) -> Union[Response, Tuple[str, int]]:
+    """
+    Streams the packet's signatures as they happen, for updating an open packet page in place
+    """
+    packet = Packet.by_id(packet_id)
+
+    if packet is None:
+        return 'Packet not found', 404
+
+    if not info['is_upper'] and info['ritdn'] != packet.freshman_username:
+        return 'Forbidden - not your packet', 403
+
+    return event_stream(packet_id, signature_visible_to(info, full=True))
+
+
+@app.route('/api/v1/stream/packets')
+@packet_auth
+@before_request
+def stream_packets(info: Dict[str, Any]) -> Response:
+    """
+    Streams the signatures of every packet as they happen, for updating the active packets page in place
+    """
+    return event_stream(None, signature_visible_to(info))
 
 
 @app.route('/readiness')
@@ -240,11 +281,71 @@ def readiness() -> Tuple[str, int]:
     return 'ready', 200
 
 
-def commit_sig(packet: Packet, was_100: bool, uid: str) -> str:
-    packet_signed_notification(packet, uid)
+def _wants_json() -> bool:
+    return request.accept_mimetypes.best_match(['text/plain', 'application/json']) == 'application/json'
+
+
+def _signer_name(kind: str, uid: str) -> str:
+    return get_rit_name(uid) if kind == 'fresh' else get_csh_name(uid)
+
+
+def _signed_kind(packet: Packet, uid: str) -> Optional[str]:
+    """
+    Same as Packet.did_sign(), but also says which of the packet's signatures the user signed with
+    :return: 'upper', 'misc', or 'fresh', or None if the user hasn't signed the packet
+    """
+    if app.config['REALM'] != 'csh':
+        return 'fresh' if packet.did_sign(uid, False) else None
+    for sig in filter(lambda sig: sig.member == uid, packet.upper_signatures):
+        return 'upper' if sig.signed else None
+    if any(sig.member == uid for sig in packet.misc_signatures):
+        return 'misc'
+    return None
+
+
+def _already_signed(packet_id: int, uid: str) -> Optional[Union[str, Response]]:
+    """
+    :return: The same response as a new signature would get if the user had already signed the open packet, else None
+    """
+    packet = Packet.by_id(packet_id)
+    if packet is None or not packet.is_open():
+        return None
+    kind = _signed_kind(packet, uid)
+    if kind is None:
+        return None
+
+    message = 'Success: Signed Packet: ' + packet.freshman_username
+    if not _wants_json():
+        return message
+    event = signature_event(packet_id, kind, uid, _signer_name(kind, uid), True, packet.signatures_received(),
+                            packet.signatures_required())
+    return jsonify({**event, 'own': True, 'reached_100': False, 'message': message})
+
+
+def _sign_failed(packet_id: int, uid: str) -> Union[str, Tuple[Response, int]]:
+    app.logger.warn("Failed to add {}'s signature to packet {}".format(uid, packet_id))
+    message = 'Error: Signature not valid.  Reason: Unknown'
+    if _wants_json():
+        return jsonify(message=message), 400
+    return message
+
+
+def commit_sig(packet_id: int, kind: str, uid: str) -> Union[str, Response]:
+    """
+    Counts a new signature of the given kind and commits it, queueing up any notifications in the same transaction
+    """
+    # The name may come from LDAP, so look it up before add_signed locks the packet for every other signer
+    name = _signer_name(kind, uid)
+    received, required, reached_100 = Packet.add_signed(packet_id, kind)
+    event = signature_event(packet_id, kind, uid, name, True, received, required)
+    publish(event)
+    enqueue_signed_notification(packet_id, uid)
+    if reached_100:
+        enqueue_100_percent_notifications(packet_id)
+        enqueue('slack_100_percent', packet_id=packet_id)
     db.session.commit()
-    if not was_100 and packet.is_100():
-        packet_100_percent_notification(packet)
-        notify_slack(packet.freshman.name)
 
-    return 'Success: Signed Packet: ' + packet.freshman_username
+    message = 'Success: Signed Packet: ' + Packet.by_id(packet_id).freshman_username
+    if not _wants_json():
+        return message
+    return jsonify({**event, 'own': True, 'reached_100': reached_100, 'message': message})
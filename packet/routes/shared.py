@@ -1,12 +1,16 @@
 """
 Routes available to both freshmen and CSH users
 """
-
-from typing import Optional, Dict, Any, Tuple, Union, List
-from flask import render_template, redirect, Response
+import os
+from itertools import chain
+from typing import Optional, Dict, Any, Tuple, Union
+from flask import Markup, render_template, redirect, request, send_file, Response
 
 from packet import auth, app
-from packet.utils import before_request, packet_auth
+from packet.avatars import THUMBNAIL_SIZES, thumbnail_path
+from packet.cache import ttl_cache
+from packet.context_processors import get_csh_names, get_rit_names
+from packet.utils import before_request, conditional_response, packet_auth
 from packet.models import Packet
 from packet.log_utils import log_cache, log_time
 
@@ -17,39 +21,52 @@ def logout() -> Response:
     return redirect('https://csh.rit.edu')
 
 
+@ttl_cache(maxsize=app.config['PACKET_FRAGMENT_CACHE_SIZE'], ttl=app.config['PACKET_FRAGMENT_CACHE_TTL'])
+def render_packet_tables(packet_id: int, _revision: int, realm: str) -> Markup:
+    """
+    Renders a packet's signature tables, which only change when the packet's revision does
+    The revision is only part of the cache key, so an old revision is never served once the packet has a new one
+    :param realm: The viewer's realm, since only CSH viewers get links to members
+    """
+    packet = Packet.by_id(packet_id, with_signatures=True)
+    return Markup(render_template('include/packet_tables.html',
+                                  realm=realm,
+                                  packet=packet,
+                                  required=packet.signatures_required(),
+                                  received=packet.signatures_received(),
+                                  upper=packet.upper_signatures,
+                                  csh_names=get_csh_names(sig.member for sig in
+                                                          chain(packet.upper_signatures, packet.misc_signatures)),
+                                  rit_names=get_rit_names(sig.freshman_username for sig in packet.fresh_signatures)))
+
+
 @app.route('/packet/<int:packet_id>/')
 @log_cache
 @packet_auth
 @before_request
 @log_time
-def freshman_packet(packet_id: int, info: Dict[str, Any]) -> Union[str, Tuple[str, int]]:
+def freshman_packet(packet_id: int, info: Dict[str, Any]) -> Union[Response, Tuple[str, int]]:
     packet = Packet.by_id(packet_id)
 
     if packet is None:
         return 'Invalid packet or freshman', 404
     else:
+        def build() -> str:
+            # Only the header depends on who's looking, everyone who can see the tables shares one cached copy
+            tables = None
+            if info['is_upper'] or packet.freshman_username == info['ritdn']:
+                tables = render_packet_tables(packet.id, packet.revision, info['realm'])
 
-        # The current user's freshman signature on this packet
-        fresh_sig: List[Any] = list(filter(
-            lambda sig: sig.freshman_username == info['ritdn'] if info else '',
-            packet.fresh_signatures
-        ))
-
-        return render_template('packet.html',
-                               info=info,
-                               packet=packet,
-                               did_sign=packet.did_sign(info['uid'], app.config['REALM'] == 'csh'),
-                               required=packet.signatures_required(),
-                               received=packet.signatures_received(),
-                               upper=packet.upper_signatures,
-                               fresh_sig=fresh_sig)
-
+            return render_template('packet.html',
+                                   info=info,
+                                   packet=packet,
+                                   did_sign=packet.has_signed(info['uid'], app.config['REALM'] == 'csh'),
+                                   required=packet.signatures_required(),
+                                   received=packet.signatures_received(),
+                                   tables=tables)
 
-def packet_sort_key(packet: Packet) -> Tuple[str, int, bool]:
-    """
-    Utility function for generating keys for sorting packets
-    """
-    return packet.freshman.name, -packet.signatures_received_result.total, not packet.did_sign_result
+        # Whether the packet is open changes the page without changing the revision
+        return conditional_response(build, packet.id, packet.revision, packet.end, packet.is_open())
 
 
 @app.route('/packets/')
@@ -57,18 +74,32 @@ def packet_sort_key(packet: Packet) -> Tuple[str, int, bool]:
 @packet_auth
 @before_request
 @log_time
-def packets(info: Dict[str, Any]) -> str:
-    open_packets = Packet.open_packets()
+def packets(info: Dict[str, Any]) -> Response:
+    def build() -> str:
+        open_packets = Packet.open_summaries(info['uid'], app.config['REALM'] == 'csh')
+
+        return render_template('active_packets.html', info=info, packets=open_packets)
+
+    return conditional_response(build, Packet.open_revision())
 
-    # Pre-calculate and store the return values of did_sign(), signatures_received(), and signatures_required()
-    for packet in open_packets:
-        packet.did_sign_result = packet.did_sign(info['uid'], app.config['REALM'] == 'csh')
-        packet.signatures_received_result = packet.signatures_received()
-        packet.signatures_required_result = packet.signatures_required()
 
-    open_packets.sort(key=packet_sort_key)
+# How long browsers keep avatars, the default image is only kept briefly since the real one may just not be resolved yet
+AVATAR_MAX_AGE = 7 * 24 * 60 * 60
+DEFAULT_AVATAR_MAX_AGE = 5 * 60
 
-    return render_template('active_packets.html', info=info, packets=open_packets)
+
+@app.route('/avatar/<kind>/<username>')
+@packet_auth
+def avatar(kind: str, username: str) -> Response:
+    path = thumbnail_path(kind, username, request.args.get('s', THUMBNAIL_SIZES[0], type=int))
+    if path is None:
+        response = send_file(os.path.join(app.static_folder, 'assets', 'default-avatar.svg'),
+                             mimetype='image/svg+xml', conditional=True, cache_timeout=DEFAULT_AVATAR_MAX_AGE)
+    else:
+        response = send_file(path, mimetype='image/jpeg', conditional=True, cache_timeout=AVATAR_MAX_AGE)
+    response.cache_control.public = False
+    response.cache_control.private = True
+    return response
 
 
 @app.route('/sw.js', methods=['GET'])
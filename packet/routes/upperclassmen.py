@@ -2,16 +2,17 @@
 Routes available to CSH users only
 """
 import json
+from itertools import chain
 
-from operator import itemgetter
-from typing import Optional, Dict, Any, List
+from typing import Optional, Dict, Any, List, Tuple, Union
 from flask import redirect, render_template, url_for, Response
 
 from packet import app
+from packet.context_processors import get_csh_names
 from packet.models import Packet
-from packet.utils import before_request, packet_auth
+from packet.utils import before_request, conditional_response, packet_auth
 from packet.log_utils import log_cache, log_time
-from packet.stats import packet_stats
+from packet.stats import packet_stats, upperclassmen_totals
 
 
 @app.route('/')
@@ -25,20 +26,19 @@ def index() -> Response:
 @packet_auth
 @before_request
 @log_time
-def upperclassman(uid: str, info: Optional[Dict[str, Any]] = None) -> str:
-    open_packets = Packet.open_packets()
+def upperclassman(uid: str, info: Optional[Dict[str, Any]] = None) -> Response:
+    def build() -> str:
+        open_packets = Packet.open_summaries(uid, True)
 
-    # Pre-calculate and store the return value of did_sign()
-    for packet in open_packets:
-        packet.did_sign_result = packet.did_sign(uid, True)
+        signatures: int = sum(map(lambda packet: 1 if packet.did_sign else 0, open_packets))
 
-    signatures: int = sum(map(lambda packet: 1 if packet.did_sign_result else 0, open_packets))
+        open_packets.sort(key=lambda packet: packet.freshman_username)
+        open_packets.sort(key=lambda packet: packet.did_sign, reverse=True)
 
-    open_packets.sort(key=lambda packet: packet.freshman_username)
-    open_packets.sort(key=lambda packet: packet.did_sign_result, reverse=True)
+        return render_template('upperclassman.html', info=info, open_packets=open_packets, member=uid,
+                               signatures=signatures)
 
-    return render_template('upperclassman.html', info=info, open_packets=open_packets, member=uid,
-                           signatures=signatures)
+    return conditional_response(build, Packet.open_revision())
 
 
 @app.route('/upperclassmen/')
@@ -46,45 +46,37 @@ def upperclassman(uid: str, info: Optional[Dict[str, Any]] = None) -> str:
 @packet_auth
 @before_request
 @log_time
-def upperclassmen_total(info: Optional[Dict[str, Any]] = None) -> str:
-    open_packets = Packet.open_packets()
+def upperclassmen_total(info: Optional[Dict[str, Any]] = None) -> Response:
+    def build() -> str:
+        totals = upperclassmen_totals()
 
-    # Sum up the signed packets per upperclassman
-    upperclassmen: Dict[str, int] = dict()
-    misc: Dict[str, int] = dict()
-    for packet in open_packets:
-        for sig in packet.upper_signatures:
-            if sig.member not in upperclassmen:
-                upperclassmen[sig.member] = 0
+        csh_names = get_csh_names(total['member'] for total in chain(totals['upperclassmen'], totals['misc']))
 
-            if sig.signed:
-                upperclassmen[sig.member] += 1
-        for sig in packet.misc_signatures:
-            misc[sig.member] = 1 + misc.get(sig.member, 0)
+        return render_template('upperclassmen_totals.html', info=info, num_open_packets=totals['open_packets'],
+                               upperclassmen=totals['upperclassmen'], misc=totals['misc'], csh_names=csh_names)
 
-    return render_template('upperclassmen_totals.html', info=info, num_open_packets=len(open_packets),
-                           upperclassmen=sorted(upperclassmen.items(), key=itemgetter(1), reverse=True),
-                           misc=sorted(misc.items(), key=itemgetter(1), reverse=True))
+    return conditional_response(build, Packet.open_revision())
 
 
 @app.route('/stats/packet/<packet_id>')
 @packet_auth
 @before_request
-def packet_graphs(packet_id: int, info: Optional[Dict[str, Any]] = None) -> str:
-    stats = packet_stats(packet_id)
-    fresh: List[int] = []
-    misc: List[int] = []
-    upper: List[int] = []
-
-    # Make a rolling sum of signatures over time
-    def agg(l: List[int], attr: str, date: str) -> None:
-        l.append((l[-1] if l else 0) + len(stats['dates'][date][attr]))
-
-    dates: List[str] = list(stats['dates'].keys())
-    for date in dates:
-        agg(fresh, 'fresh', date)
-        agg(misc, 'misc', date)
-        agg(upper, 'upper', date)
+def packet_graphs(packet_id: int, info: Optional[Dict[str, Any]] = None) -> Union[Response, Tuple[str, int]]:
+    packet = Packet.by_id(packet_id)
+    if packet is None:
+        return 'Invalid packet', 404
+
+    return conditional_response(lambda: _render_packet_graphs(packet, info), packet.id, packet.revision, packet.start,
+                                packet.end)
+
+
+def _render_packet_graphs(packet: Packet, info: Optional[Dict[str, Any]]) -> str:
+    stats = packet_stats(packet.id)
+
+    dates: List[str] = list(stats['accum'].keys())
+    fresh: List[int] = [stats['accum'][date]['fresh'] for date in dates]
+    misc: List[int] = [stats['accum'][date]['misc'] for date in dates]
+    upper: List[int] = [stats['accum'][date]['upper'] for date in dates]
 
     # Stack misc and upper on top of fresh for a nice stacked line graph
     for i in range(len(dates)):
@@ -101,9 +93,11 @@ def packet_graphs(packet_id: int, info: Optional[Dict[str, Any]] = None) -> str:
                 'upper': upper,
                 },
             'daily': {
-
+                'fresh': [stats['daily'][date]['fresh'] for date in dates],
+                'misc': [stats['daily'][date]['misc'] for date in dates],
+                'upper': [stats['daily'][date]['upper'] for date in dates],
                 }
         }),
         fresh=stats['freshman'],
-        packet=Packet.by_id(packet_id),
+        packet=packet,
     )
@@ -0,0 +1,77 @@
+"""
+A local SMTP server that accepts and counts mail without delivering it, for measuring the mail path without a real
+mail server
+"""
+import socketserver
+import threading
+from typing import Any, Optional
+
+
+class _SMTPHandler(socketserver.StreamRequestHandler):
+    server: 'SMTPSink'
+
+    def reply(self, line: str) -> None:
+        self.wfile.write((line + '\r\n').encode())
+
+    def handle(self) -> None:
+        self.server.connections += 1
+        self.reply('220 packet smtp sink')
+        recipients: list[str] = []
+        while True:
+            line = self.rfile.readline().decode(errors='replace').strip()
+            command = line[:4].upper()
+            if not line or command == 'QUIT':
+                self.reply('221 Bye')
+                return
+            if command in ('HELO', 'EHLO'):
+                self.reply('250 packet smtp sink')
+            elif command == 'RCPT':
+                recipient = line.split(':', 1)[1].strip()
+                if recipient.strip('<>') in self.server.refuse:
+                    self.reply('550 Refused by sink')
+                else:
+                    recipients.append(recipient)
+                    self.reply('250 OK')
+            elif command == 'DATA':
+                self.reply('354 End data with <CR><LF>.<CR><LF>')
+                while self.rfile.readline() not in (b'.\r\n', b'.\n', b''):
+                    pass
+                self.server.record(recipients)
+                recipients = []
+                self.reply('250 OK')
+            elif command == 'RSET':
+                recipients = []
+                self.reply('250 OK')
+            else:
+                self.reply('250 OK')
+
+
+class SMTPSink(socketserver.ThreadingTCPServer):
+    """
+    Run it with a with statement, it listens on a free local port until the block exits
+    :param refuse: Addresses to refuse, for exercising per-recipient failures
+    """
+    daemon_threads = True
+
+    def __init__(self, refuse: Optional[set[str]] = None) -> None:
+        super().__init__(('127.0.0.1', 0), _SMTPHandler)
+        self.refuse = refuse or set()
+        self.connections = 0
+        self.messages: list[list[str]] = []
+        self._lock = threading.Lock()
+
+    @property
+    def port(self) -> int:
+        return self.server_address[1]
+
+    def record(self, recipients: list[str]) -> None:
+        with self._lock:
+            self.messages.append(recipients)
+
+    def __enter__(self) -> 'SMTPSink':
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *args: Any) -> None:
+        self.shutdown()
+        self.server_close()
@@ -0,0 +1,133 @@
+// Keeps packet pages up to date from the signature events streamed by /api/v1/stream/, and from sign responses
+var PacketLive = (function () {
+
+    const SIGNED_COLOR = '#4caf505e';
+    const REQUIRED_MISC = 10;
+
+    function score(received, required, count) {
+        return (received[count] / required[count] * 100).toFixed(2);
+    }
+
+    // The counts, scores, and progress bars on a packet page
+    function updatePacketCounts(scope, received, required) {
+        scope.find('[data-count]').each(function () {
+            const count = this.dataset.count;
+            $(this).text(received[count] + '/' + required[count]);
+        });
+        scope.find('[data-score-text]').each(function () {
+            $(this).text(score(received, required, this.dataset.scoreText));
+        });
+        scope.find('[data-score]').each(function () {
+            const value = score(received, required, this.dataset.score);
+            $(this).attr('aria-valuenow', value).css('width', value + '%');
+        });
+    }
+
+    // The count columns of a row on the active packets page
+    function updateListCounts(scope, received, required) {
+        scope.find('[data-list-count]').each(function () {
+            const count = this.dataset.listCount;
+            $(this).attr('data-sort', received[count])
+                .text(received[count] === required[count] ? '💯' : received[count] + ' / ' + required[count]);
+        });
+        if ($.fn.dataTable && $.fn.dataTable.isDataTable('#active_packets_table')) {
+            scope.filter('tr').each(function () {
+                $('#active_packets_table').DataTable().row(this).invalidate('dom');
+            });
+        }
+    }
+
+    function markRow(row, signed) {
+        row.css('background-color', signed ? SIGNED_COLOR : '');
+        row.children('td').last().find('i')
+            .toggleClass('fa-check', signed)
+            .toggleClass('fa-times', !signed);
+    }
+
+    // Misc signatures are numbered rows that only exist once signed, and anything past the required number is extra
+    function renumberMisc(body) {
+        body.children('tr').each(function (index) {
+            const cells = $(this).children('td');
+            cells.first().text((index + 1) + '.');
+            if (index < REQUIRED_MISC) {
+                cells.last().empty().append($('<i class="fas fa-check"></i>'));
+            } else {
+                cells.last().empty().append($('<p>').text('Extra!'));
+            }
+        });
+    }
+
+    function addMiscRow(body, signer, name) {
+        const image = $('<img class="eval-user-img" loading="lazy" width="25" height="25"/>')
+            .attr('alt', signer)
+            .attr('src', '/avatar/csh/' + encodeURIComponent(signer))
+            .attr('data-zoom-src', '/avatar/csh/' + encodeURIComponent(signer) + '?s=200');
+        let member = $('<td>').append(image, ' ', document.createTextNode(name || signer));
+        if (body.data('realm') === 'csh') {
+            member = $('<td>').append($('<a>').attr('href', '/member/' + signer).append(member.contents()));
+        }
+        body.append($('<tr>').attr('data-signer', signer).css('background-color', SIGNED_COLOR)
+            .append($('<td width="3%">'), member, $('<td width="15%">')));
+    }
+
+    function updateSignature(scope, event) {
+        if (event.signer === undefined) {
+            return;
+        }
+        const body = scope.find('tbody[data-kind="' + event.kind + '"]');
+        const row = body.children('tr').filter(function () {
+            return this.dataset.signer === event.signer;
+        });
+        if (event.kind !== 'misc') {
+            markRow(row, event.signed);
+            return;
+        }
+        if (event.signed && row.length === 0) {
+            addMiscRow(body, event.signer, event.name);
+        } else if (!event.signed) {
+            row.remove();
+        }
+        renumberMisc(body);
+    }
+
+    function markSignedByViewer(event) {
+        if (!event.own || !event.signed) {
+            return;
+        }
+        $('tr[data-packet-id="' + event.packet_id + '"]').css('background-color', SIGNED_COLOR);
+        $('.sign-button[data-packet_id="' + event.packet_id + '"]')
+            .removeClass('sign-button')
+            .addClass('signed-button')
+            .prop('disabled', true)
+            .html('<i class="fa fa-check"></i>&nbsp;Signed');
+    }
+
+    /**
+     * Patches every part of the page showing the event's packet
+     * @param event A signature event with the packet's new received and required counts, or just the counts when they
+     *              changed for another reason
+     */
+    function apply(event) {
+        const scope = $('[data-packet-id="' + event.packet_id + '"]');
+        updatePacketCounts(scope.not('tr'), event.received, event.required);
+        updateListCounts(scope.filter('tr'), event.received, event.required);
+        updateSignature(scope.not('tr'), event);
+        markSignedByViewer(event);
+    }
+
+    $(document).ready(function () {
+        if (!window.EventSource) {
+            return;
+        }
+        $('[data-stream]').each(function () {
+            const source = new EventSource(this.dataset.stream);
+            source.addEventListener('signature', function (message) {
+                apply(JSON.parse(message.data));
+            });
+        });
+    });
+
+    return {
+        apply: apply,
+    };
+})();
@@ -24,7 +24,7 @@ $(document).ready(function () {
                 <div id="zoom-photo" style="position: absolute; z-index: 1050; display: block">
                     <img class="eval-user-img"
                         alt=${photo.alt}
-                        src=${photo.src}
+                        src=${photo.dataset.zoomSrc || photo.src}
                         style="max-width: 200px; max-height: 200px; border: 1px solid #666"
                         >
                 </div>
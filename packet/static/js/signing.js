@@ -24,15 +24,22 @@ $(document).ready(function () {
                     $.ajax({
                         url: "/api/v1/sign/" + packetData.packet_id + "/",
                         method: "POST",
+                        dataType: "json",
                         success: function (data) {
+                            PacketLive.apply(data);
                             dialogs.fire({
                                 title: "Packet Signed",
-                                text: "You've signed " + packetData.freshman_name + "'s packet",
+                                text: "You've signed " + packetData.freshman_name + "'s packet" +
+                                    (data.reached_100 ? ", bringing it to 100%!" : ""),
                                 type: "success",
-                            })
-                                .then(() => {
-                                    location.reload();
-                                });
+                            });
+                        },
+                        error: function (request) {
+                            dialogs.fire({
+                                title: "Couldn't Sign Packet",
+                                text: request.responseJSON ? request.responseJSON.message : "Please try again",
+                                type: "error",
+                            });
                         }
                     });
                 }
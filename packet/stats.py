@@ -1,7 +1,10 @@
-from datetime import date as dateType, timedelta
-from typing import TypedDict, Union, cast, Callable
+from datetime import date as dateType, datetime, timedelta
+from typing import Any, Optional, TypedDict, cast
 
-from packet.models import Packet, MiscSignature, UpperSignature
+from sqlalchemy import func, literal_column, select, union_all
+
+from packet import db
+from packet.models import Packet, FreshSignature, MiscSignature, UpperSignature
 
 # Types
 class Freshman(TypedDict):
@@ -13,33 +16,94 @@ class WhoSigned(TypedDict):
     misc: list[str]
     fresh: list[str]
 
-class PacketStats(TypedDict):
+class SigTypeCounts(TypedDict):
+    upper: int
+    misc: int
+    fresh: int
+
+class PacketCounts(TypedDict):
     packet_id: int
     freshman: Freshman
-    dates: dict[str, dict[str, list[str]]]
+    daily: dict[str, SigTypeCounts]
+    accum: dict[str, SigTypeCounts]
+
+class PacketStats(PacketCounts, total=False):
+    dates: dict[str, WhoSigned]
 
 class SimplePacket(TypedDict):
     id: int
     freshman_username: str
 
-class SigDict(TypedDict):
-    date: dateType
-    packet: SimplePacket
 
-Stats = dict[dateType, list[str]]
+def _signed_sigs(packet_id: int) -> dict[str, tuple[Any, Any, tuple]]:
+    """
+    :return: The uid column, updated column, and filters selecting the signed signatures of a packet for each type
+    """
+    return {
+            'upper': (UpperSignature.member, UpperSignature.updated,
+                      (UpperSignature.packet_id == packet_id, UpperSignature.signed)),
+            'fresh': (FreshSignature.freshman_username, FreshSignature.updated,
+                      (FreshSignature.packet_id == packet_id, FreshSignature.signed)),
+            'misc': (MiscSignature.member, MiscSignature.updated, (MiscSignature.packet_id == packet_id,)),
+            }
+
+
+def _count_per_day(sigs: dict[str, tuple[Any, Any, tuple]],
+                   dates: list[dateType]) -> tuple[dict[str, SigTypeCounts], dict[str, SigTypeCounts]]:
+    """
+    Counts the signatures of each type per day, along with a running total using a window function
+    Only signatures made on one of the given days are counted, so the running totals start at 0 on the first day
+    :return: The per day counts and the running totals, keyed by the days' ISO dates
+    """
+    per_day = union_all(*(
+        select(literal_column("'{}'".format(kind)).label('kind'), func.date(updated).label('day'),
+               func.count().label('count'))
+        .where(*where, func.date(updated).between(dates[0], dates[-1]))
+        .group_by(func.date(updated))
+        for kind, (_, updated, where) in sigs.items()
+    )).subquery()
+    rows = db.session.execute(
+        select(per_day.c.kind, per_day.c.day, per_day.c.count,
+               func.sum(per_day.c.count).over(partition_by=per_day.c.kind, order_by=per_day.c.day))
+    ).all()
+
+    daily: dict[dateType, dict[str, int]] = {date: {kind: 0 for kind in sigs} for date in dates}
+    running: dict[dateType, dict[str, int]] = {date: dict() for date in dates}
+    for kind, day, count, accum in rows:
+        if day in daily:
+            daily[day][kind] = count
+            running[day][kind] = accum
+
+    # Carry the running totals across days without any signatures
+    accum_stats = dict()
+    last = {kind: 0 for kind in sigs}
+    for date in dates:
+        last = {**last, **running[date]}
+        accum_stats[date.isoformat()] = cast(SigTypeCounts, dict(last))
+
+    return {date.isoformat(): cast(SigTypeCounts, daily[date]) for date in dates}, accum_stats
 
 
-def packet_stats(packet_id: int) -> PacketStats:
+def packet_stats(packet_id: int, with_uids: bool = False) -> PacketStats:
     """
     Gather statistics for a packet in the form of number of signatures per day
 
+    The per day counts and running totals are bucketed by the database, the lists of who signed on each day are only
+    fetched when with_uids is set
+
     Return format: {
         packet_id,
         freshman: {
             name,
             rit_username,
         },
-        dates: {
+        daily: {
+            <date>: { upper: <count>, misc: <count>, fresh: <count> },
+        },
+        accum: {
+            <date>: { upper: <count>, misc: <count>, fresh: <count> },
+        },
+        dates: { # Only included if with_uids is set
            <date>: {
                 upper: [ uid ],
                 misc: [ uid ],
@@ -51,54 +115,29 @@ def packet_stats(packet_id: int) -> PacketStats:
     packet = Packet.by_id(packet_id)
 
     dates = [packet.start.date() + timedelta(days=x) for x in range(0, (packet.end-packet.start).days + 1)]
+    sigs = _signed_sigs(packet_id)
+    daily, accum = _count_per_day(sigs, dates)
 
-    print(dates)
-
-    upper_stats: Stats = {date: list() for date in dates}
-    for uid, date in map(lambda sig: (sig.member, sig.updated),
-                         filter(lambda sig: sig.signed, packet.upper_signatures)):
-        upper_stats[date.date()].append(uid)
-
-    fresh_stats: Stats = {date: list() for date in dates}
-    for username, date in map(lambda sig: (sig.freshman_username, sig.updated),
-                              filter(lambda sig: sig.signed, packet.fresh_signatures)):
-        fresh_stats[date.date()].append(username)
-
-    misc_stats: Stats = {date: list() for date in dates}
-    for uid, date in map(lambda sig: (sig.member, sig.updated), packet.misc_signatures):
-        misc_stats[date.date()].append(uid)
-
-    total_stats = dict()
-    for date in dates:
-        total_stats[date.isoformat()] = {
-                'upper': upper_stats[date],
-                'fresh': fresh_stats[date],
-                'misc': misc_stats[date],
-                }
-
-    return {
+    stats: PacketStats = {
             'packet_id': packet_id,
             'freshman': {
                 'name': packet.freshman.name,
                 'rit_username': packet.freshman.rit_username,
                 },
-            'dates': total_stats,
+            'daily': daily,
+            'accum': accum,
             }
 
+    if with_uids:
+        who_signed: dict[dateType, dict[str, list[str]]] = {date: {kind: list() for kind in sigs} for date in dates}
+        for kind, (uid, updated, where) in sigs.items():
+            for username, date in db.session.query(uid, func.date(updated)).filter(*where).order_by(updated):
+                if date in who_signed:
+                    who_signed[date][kind].append(username)
+        stats['dates'] = {date.isoformat(): cast(WhoSigned, who_signed[date]) for date in dates}
+
+    return stats
 
-def sig2dict(sig: Union[UpperSignature, MiscSignature]) -> SigDict:
-    """
-    A utility function for upperclassman stats.
-    Converts an UpperSignature to a dictionary with the date and the packet.
-    """
-    packet = Packet.by_id(sig.packet_id)
-    return {
-            'date': sig.updated.date(),
-            'packet': {
-                'id': packet.id,
-                'freshman_username': packet.freshman_username,
-                },
-            }
 
 class UpperStats(TypedDict):
     member: str
@@ -119,24 +158,90 @@ def upperclassman_stats(uid: str) -> UpperStats:
     }
     """
 
-    sigs = UpperSignature.query.filter(
-            UpperSignature.signed,
-            UpperSignature.member == uid
-            ).all() + MiscSignature.query.filter(MiscSignature.member == uid).all()
+    # Every signed upper and misc signature of the member along with its packet, in one round trip
+    upper = select(func.date(UpperSignature.updated).label('date'), Packet.id, Packet.freshman_username) \
+        .join(Packet, UpperSignature.packet_id == Packet.id) \
+        .where(UpperSignature.member == uid, UpperSignature.signed)
+    misc = select(func.date(MiscSignature.updated).label('date'), Packet.id, Packet.freshman_username) \
+        .join(Packet, MiscSignature.packet_id == Packet.id) \
+        .where(MiscSignature.member == uid)
+    sigs = union_all(upper, misc).subquery()
+
+    signatures: dict[str, list[SimplePacket]] = dict()
+    for date, packet_id, freshman_username in db.session.execute(select(sigs).order_by(sigs.c.date)):
+        signatures.setdefault(date.isoformat(), list()).append({
+                'id': packet_id,
+                'freshman_username': freshman_username,
+                })
+
+    return {
+            'member': uid,
+            'signatures': signatures,
+            }
+
+
+def upperclassman_last_change(uid: str) -> tuple[int, Optional[datetime]]:
+    """
+    Checks whether upperclassman_stats() would return something new without running it
+    :return: The number of signatures the member made and the last time any of their signatures changed
+    """
+    upper_count = func.count().filter(UpperSignature.signed)
+    upper, upper_updated = db.session.query(upper_count, func.max(UpperSignature.updated)) \
+        .filter(UpperSignature.member == uid) \
+        .one()
+    misc, misc_updated = db.session.query(func.count(), func.max(MiscSignature.updated)) \
+        .filter(MiscSignature.member == uid) \
+        .one()
+    updated = [date for date in (upper_updated, misc_updated) if date is not None]
+    return upper + misc, max(updated) if updated else None
+
+
+class MemberTotal(TypedDict):
+    member: str
+    signatures: int
+
+class UpperTotals(TypedDict):
+    open_packets: int
+    upperclassmen: list[MemberTotal]
+    misc: list[MemberTotal]
 
-    sig_dicts = list(map(sig2dict, sigs))
+def upperclassmen_totals() -> UpperTotals:
+    """
+    Rank upperclassmen and misc signers by the number of open packets they've signed
 
-    dates = set(map(lambda sd: sd['date'], sig_dicts))
+    Return format: {
+        open_packets: <number of open packets>,
+        upperclassmen: [{
+            member: <uid>,
+            signatures: <number of signed open packets>,
+        }],
+        misc: [{
+            member: <uid>,
+            signatures: <number of signed open packets>,
+        }],
+    }
+    """
+    now = datetime.now()
+    is_open = (Packet.start < now, Packet.end > now)
+
+    upper_count = func.count().filter(UpperSignature.signed)
+    upper = db.session.query(UpperSignature.member, upper_count) \
+        .join(Packet, UpperSignature.packet_id == Packet.id) \
+        .filter(*is_open) \
+        .group_by(UpperSignature.member) \
+        .order_by(upper_count.desc(), UpperSignature.member) \
+        .all()
+
+    misc_count = func.count()
+    misc = db.session.query(MiscSignature.member, misc_count) \
+        .join(Packet, MiscSignature.packet_id == Packet.id) \
+        .filter(*is_open) \
+        .group_by(MiscSignature.member) \
+        .order_by(misc_count.desc(), MiscSignature.member) \
+        .all()
 
     return {
-            'member': uid,
-            'signatures': {
-                date.isoformat() : list(
-                    map(lambda sd: sd['packet'],
-                        filter(cast(Callable, lambda sig, d=date: sig['date'] == d),
-                            sig_dicts
-                            )
-                        )
-                    ) for date in dates
-                }
+            'open_packets': Packet.query.filter(*is_open).count(),
+            'upperclassmen': [{'member': member, 'signatures': count} for member, count in upper],
+            'misc': [{'member': member, 'signatures': count} for member, count in misc],
             }
@@ -1,23 +1,79 @@
 """
 General utilities and decorators for supporting the Python logic
 """
-from datetime import datetime, timedelta
+import hashlib
+from datetime import datetime, timedelta, timezone
 from functools import wraps, lru_cache
-from typing import Any, Callable, TypeVar, cast
+from itertools import chain
+from typing import Any, Callable, Optional, TypedDict, TypeVar, cast
 from urllib.parse import urlparse
 
-import requests
-from flask import session, redirect, request
+from flask import Response, g, make_response, session, redirect, request
+from sqlalchemy import Table, and_, bindparam, exists, literal, or_, select
+from sqlalchemy.dialects.postgresql import insert as pg_insert
 
 from packet import auth, app, db, ldap
-from packet.mail import send_start_packet_mail
+from packet.cache import ttl_cache
+from packet.events import counts_event, publish
+from packet.jobs import enqueue
 from packet.models import Freshman, FreshSignature, Packet, UpperSignature, MiscSignature
-from packet.notifications import packets_starting_notification, packet_starting_notification
 
 INTRO_REALM = 'https://sso.csh.rit.edu/auth/realms/intro'
 
 WrappedFunc = TypeVar('WrappedFunc', bound=Callable)
 
+
+class Identity:
+    """
+    Who the logged in user is and what they're allowed to do, resolved by current_identity() so the auth decorators
+    and routes don't each look the user up in LDAP again
+    """
+
+    def __init__(self, realm: str, uid: str, ritdn: Optional[str], groups: frozenset[str] = frozenset(),
+                 intromember: bool = False, evals: bool = False, onfloor: bool = False):
+        self.realm = realm
+        self.uid = uid
+        self.ritdn = ritdn
+        self.groups = groups
+        self.intromember = intromember
+        self.evals = evals
+        self.onfloor = onfloor
+
+
+    @property
+    def is_frosh(self) -> bool:
+        # Everyone in the intro realm is a freshman
+        return self.realm == 'intro' or self.intromember
+
+
+    def validator(self) -> tuple:
+        """
+        :return: Everything about the user a page can depend on, in the same order in every process
+        """
+        return self.realm, self.uid, self.ritdn, sorted(self.groups), self.intromember, self.evals, self.onfloor
+
+
+@ttl_cache(maxsize=app.config['LDAP_MEMBER_CACHE_SIZE'], ttl=app.config['IDENTITY_CACHE_TTL'])
+def _resolve_identity(issuer: str, uid: str) -> Identity:
+    if issuer == INTRO_REALM:
+        return Identity('intro', uid, uid, onfloor=is_freshman_on_floor(uid))
+    member = ldap.get_member(uid)
+    return Identity('csh', uid, member.ritdn, frozenset(ldap.get_groups(member)), ldap.is_intromember(member),
+                    ldap.is_evals(member))
+
+
+def current_identity() -> Identity:
+    """
+    Resolves the logged in user once per request, and for each user at most once every IDENTITY_CACHE_TTL seconds
+    """
+    identity = g.get('identity')
+    if identity is None:
+        identity = _resolve_identity(session['id_token']['iss'],
+                                     str(session['userinfo'].get('preferred_username', '')))
+        g.identity = identity
+    return identity
+
+
 def before_request(func: WrappedFunc) -> WrappedFunc:
     """
     Credit to Liam Middlebrook and Ram Zallan
@@ -26,25 +82,24 @@ def before_request(func: WrappedFunc) -> WrappedFunc:
 
     @wraps(func)
     def wrapped_function(*args: list, **kwargs: dict) -> Any:
-        uid = str(session['userinfo'].get('preferred_username', ''))
-        if session['id_token']['iss'] == INTRO_REALM:
+        identity = current_identity()
+        if identity.realm == 'intro':
             info = {
                 'realm': 'intro',
-                'uid': uid,
-                'onfloor': is_freshman_on_floor(uid),
+                'uid': identity.uid,
+                'onfloor': identity.onfloor,
                 'admin': False,  # It's always false if frosh
-                'ritdn': uid,
+                'ritdn': identity.ritdn,
                 'is_upper': False, # Always fals in intro realm
             }
         else:
-            member = ldap.get_member(uid)
             info = {
                 'realm': 'csh',
-                'uid': uid,
-                'admin': ldap.is_evals(member),
-                'groups': ldap.get_groups(member),
-                'ritdn': member.ritdn,
-                'is_upper': not is_frosh(),
+                'uid': identity.uid,
+                'admin': identity.evals,
+                'groups': list(identity.groups),
+                'ritdn': identity.ritdn,
+                'is_upper': not identity.is_frosh,
             }
 
         kwargs['info'] = info
@@ -53,6 +108,38 @@ def before_request(func: WrappedFunc) -> WrappedFunc:
     return cast(WrappedFunc, wrapped_function)
 
 
+def conditional_response(build: Callable[[], Any], *validator: Any,
+                         last_modified: Optional[datetime] = None) -> Response:
+    """
+    Gives the response a strong ETag made from the validator, the viewer and the app version, and answers with 304 Not
+    Modified instead of calling build when the client's copy is still current
+    :param build: Makes the response body, only called when it has to be sent
+    :param validator: Values that change whenever the resource does, like a packet's revision
+    :param last_modified: When the resource last changed in local time, for clients that only send If-Modified-Since
+    """
+    etag = hashlib.sha1(repr((app.config['VERSION'], current_identity().validator(), validator)).encode()).hexdigest()
+    if last_modified is not None:
+        last_modified = last_modified.astimezone(timezone.utc).replace(microsecond=0)
+
+    if request.if_none_match:
+        fresh = request.if_none_match.contains(etag)
+    else:
+        since = request.if_modified_since
+        if since is not None and since.tzinfo is None:
+            since = since.replace(tzinfo=timezone.utc)
+        fresh = last_modified is not None and since is not None and last_modified <= since
+
+    response = Response(status=304) if fresh else make_response(build())
+    if response.status_code in (200, 304):
+        response.set_etag(etag)
+        if last_modified is not None:
+            response.last_modified = last_modified
+        # Browsers revalidate on every view, which is cheap, instead of showing a packet that's out of date
+        response.cache_control.private = True
+        response.cache_control.no_cache = True
+    return response
+
+
 @lru_cache(maxsize=128)
 def is_freshman_on_floor(rit_username: str) -> bool:
     """
@@ -85,9 +172,9 @@ def packet_auth(func: WrappedFunc) -> WrappedFunc:
     @wraps(func)
     def wrapped_function(*args: list, **kwargs: dict) -> Any:
         if app.config['REALM'] == 'csh':
-            username = str(session['userinfo'].get('preferred_username', ''))
-            if ldap.is_intromember(ldap.get_member(username)):
-                app.logger.warn('Stopped intro member {} from accessing upperclassmen packet'.format(username))
+            identity = current_identity()
+            if identity.intromember:
+                app.logger.warn('Stopped intro member {} from accessing upperclassmen packet'.format(identity.uid))
                 return redirect(app.config['PROTOCOL'] + app.config['PACKET_INTRO'], code=301)
 
         return func(*args, **kwargs)
@@ -104,10 +191,9 @@ def admin_auth(func: WrappedFunc) -> WrappedFunc:
     @wraps(func)
     def wrapped_function(*args: list, **kwargs: dict) -> Any:
         if app.config['REALM'] == 'csh':
-            username = str(session['userinfo'].get('preferred_username', ''))
-            member = ldap.get_member(username)
-            if not ldap.is_evals(member):
-                app.logger.warn('Stopped member {} from accessing admin UI'.format(username))
+            identity = current_identity()
+            if not identity.evals:
+                app.logger.warn('Stopped member {} from accessing admin UI'.format(identity.uid))
                 return redirect(app.config['PROTOCOL'] + app.config['PACKET_UPPER'], code=301)
         else:
             return redirect(app.config['PROTOCOL'] + app.config['PACKET_INTRO'], code=301)
@@ -117,162 +203,268 @@ def admin_auth(func: WrappedFunc) -> WrappedFunc:
     return cast(WrappedFunc, wrapped_function)
 
 
-def notify_slack(name: str) -> None:
+class FreshmanSyncSummary(TypedDict):
+    freshmen_changed: int
+    freshmen_offfloor: int
+    signatures_created: int
+
+
+def sync_freshman(freshmen_list: dict) -> FreshmanSyncSummary:
     """
-    Sends a congratulate on sight decree to Slack
+    Makes the freshmen in the DB match the given roster using a few set-based statements, so syncing an unchanged
+    roster doesn't write anything
+    :return: The number of rows changed of each kind
     """
-    if app.config['SLACK_WEBHOOK_URL'] is None:
-        app.logger.warn('SLACK_WEBHOOK_URL not configured, not sending message to slack.')
-        return
+    now = datetime.now()
+    usernames = list(freshmen_list)
+
+    # Add new freshmen and update existing ones, skipping rows that haven't changed
+    changed: list[str] = []
+    if freshmen_list:
+        upsert = pg_insert(Freshman.__table__).values([{
+            'rit_username': freshman.rit_username,
+            'name': freshman.name,
+            'onfloor': freshman.onfloor,
+        } for freshman in freshmen_list.values()])
+        upsert = upsert.on_conflict_do_update(
+            index_elements=[Freshman.rit_username],
+            set_={'name': upsert.excluded.name, 'onfloor': upsert.excluded.onfloor},
+            where=or_(Freshman.name != upsert.excluded.name, Freshman.onfloor != upsert.excluded.onfloor),
+        )
+        changed = db.session.execute(upsert.returning(Freshman.rit_username)).scalars().all()
 
-    msg = f':pizza-party: {name} got :100: on packet! :pizza-party:'
-    requests.put(app.config['SLACK_WEBHOOK_URL'], json={'text': msg})
-    app.logger.info('Posted 100% notification to slack for ' + name)
+    # Update all freshmen entries that represent people who are no longer freshmen
+    offfloor = db.session.execute(
+        Freshman.__table__.update()
+        .where(Freshman.onfloor, cast(Any, Freshman.rit_username).notin_(usernames))
+        .values(onfloor=False)
+        .returning(Freshman.rit_username)
+    ).scalars().all()
+
+    # Add any missing freshmen signatures to each open or future packet
+    missing = select(Packet.id, Freshman.rit_username, literal(False), literal(now)) \
+        .join(Freshman, Freshman.rit_username != Packet.freshman_username) \
+        .where(Packet.end > now, cast(Any, Freshman.rit_username).in_(usernames),
+               ~exists().where(and_(FreshSignature.packet_id == Packet.id,
+                                    FreshSignature.freshman_username == Freshman.rit_username)))
+    signatures_created = db.session.execute(FreshSignature.__table__.insert().from_select(
+        ['packet_id', 'freshman_username', 'signed', 'updated'], missing)).rowcount
+
+    if signatures_created:
+        Packet.recount_signatures(Packet.end > now)
+    elif changed or offfloor:
+        # A freshman shows up on their own packet and on every packet they can sign, so those need new revisions
+        affected = set(changed) | set(offfloor)
+        Packet.recount_signatures(Packet.end > now, or_(
+            cast(Any, Packet.freshman_username).in_(affected),
+            exists().where(and_(FreshSignature.packet_id == Packet.id,
+                                cast(Any, FreshSignature.freshman_username).in_(affected)))))
+    db.session.commit()
+    is_freshman_on_floor.cache_clear()
 
+    summary: FreshmanSyncSummary = {
+        'freshmen_changed': len(changed),
+        'freshmen_offfloor': len(offfloor),
+        'signatures_created': signatures_created,
+    }
+    app.logger.info('Freshmen sync changed {freshmen_changed} freshmen, moved {freshmen_offfloor} off floor, and '
+                    'created {signatures_created} signatures'.format(**summary))
+    return summary
 
-def sync_freshman(freshmen_list: dict) -> None:
-    freshmen_in_db = {freshman.rit_username: freshman for freshman in Freshman.query.all()}
 
-    for list_freshman in freshmen_list.values():
-        if list_freshman.rit_username not in freshmen_in_db:
-            # This is a new freshman so add them to the DB
-            freshmen_in_db[list_freshman.rit_username] = Freshman(rit_username=list_freshman.rit_username,
-                                                                  name=list_freshman.name,
-                                                                  onfloor=list_freshman.onfloor)
-            db.session.add(freshmen_in_db[list_freshman.rit_username])
-        else:
-            # This freshman is already in the DB so just update them
-            freshmen_in_db[list_freshman.rit_username].onfloor = list_freshman.onfloor
-            freshmen_in_db[list_freshman.rit_username].name = list_freshman.name
+# The number of signature rows sent to the DB per INSERT when creating packets
+INSERT_BATCH_SIZE = 5000
 
-    # Update all freshmen entries that represent people who are no longer freshmen
-    for freshman in filter(lambda freshman: freshman.rit_username not in freshmen_list, freshmen_in_db.values()):
-        freshman.onfloor = False
-
-    # Update the freshmen signatures of each open or future packet
-    for packet in Packet.query.filter(Packet.end > datetime.now()).all():
-        # pylint: disable=cell-var-from-loop
-        current_fresh_sigs = set(map(lambda fresh_sig: fresh_sig.freshman_username, packet.fresh_signatures))
-        for list_freshman in filter(lambda list_freshman: list_freshman.rit_username not in current_fresh_sigs and
-                                                          list_freshman.rit_username != packet.freshman_username,
-                                    freshmen_list.values()):
-            db.session.add(FreshSignature(packet=packet, freshman=freshmen_in_db[list_freshman.rit_username]))
 
-    db.session.commit()
+class PacketCreationSummary(TypedDict):
+    packets: int
+    upper_signatures: int
+    fresh_signatures: int
+    seconds: float
 
 
-def create_new_packets(base_date: datetime, freshmen_list: dict) -> None:
+def _insert_in_batches(table: Table, rows: list[dict[str, Any]]) -> None:
+    """
+    Inserts the given rows using executemany in batches of INSERT_BATCH_SIZE
+    """
+    for i in range(0, len(rows), INSERT_BATCH_SIZE):
+        db.session.execute(table.insert(), rows[i:i + INSERT_BATCH_SIZE])
+
+
+def _upper_roles() -> dict[str, dict[str, Any]]:
+    """
+    Fetches the active upperclassmen and their roles from LDAP
+    :return: The role columns of each upperclassman's signatures keyed by uid
+    """
+    # Start from a fresh snapshot and member cache so the sync sees changes made since they were loaded, which also
+    # lets members' new groups and anyone newly added to LDAP be seen straight away
+    ldap.clear_member_cache()
+    all_upper = filter(
+        lambda member: not ldap.is_intromember(member) and not ldap.is_on_coop(member), ldap.get_active_members())
+
+    rtp = set(ldap.get_active_rtps())
+    three_da = set(ldap.get_3das())
+    webmaster = set(ldap.get_webmasters())
+    c_m = set(ldap.get_constitutional_maintainers())
+    w_m = set(ldap.get_wiki_maintainers())
+    drink = set(ldap.get_drink_admins())
+
+    return {member.uid: {
+        'eboard': ldap.get_eboard_role(member),
+        'active_rtp': member.uid in rtp,
+        'three_da': member.uid in three_da,
+        'webmaster': member.uid in webmaster,
+        'c_m': member.uid in c_m,
+        'w_m': member.uid in w_m,
+        'drink_admin': member.uid in drink,
+    } for member in all_upper}
+
+
+def create_new_packets(base_date: datetime, freshmen_list: dict) -> PacketCreationSummary:
+    """
+    Creates a packet for each of the given freshmen along with all of their signature rows
+    :return: The number of rows created and how long it took
+    """
+    started = datetime.now()
     start = base_date
     end = base_date + timedelta(days=14)
 
     app.logger.info('Fetching data from LDAP...')
-    all_upper = list(filter(
-        lambda member: not ldap.is_intromember(member) and not ldap.is_on_coop(member), ldap.get_active_members()))
-
-
-    rtp = ldap.get_active_rtps()
-    three_da = ldap.get_3das()
-    webmaster = ldap.get_webmasters()
-    c_m = ldap.get_constitutional_maintainers()
-    w_m = ldap.get_wiki_maintainers()
-    drink = ldap.get_drink_admins()
-
-    # Packet starting notifications
-    packets_starting_notification(start)
-
-    # Create the new packets and the signatures for each freshman in the given CSV
-    app.logger.info('Creating DB entries and sending emails...')
-    for freshman in Freshman.query.filter(cast(Any, Freshman.rit_username).in_(freshmen_list)).all():
-        packet = Packet(freshman=freshman, start=start, end=end)
-        db.session.add(packet)
-        send_start_packet_mail(packet)
-        packet_starting_notification(packet)
-
-        for member in all_upper:
-            sig = UpperSignature(packet=packet, member=member.uid)
-            sig.eboard = ldap.get_eboard_role(member)
-            sig.active_rtp = member.uid in rtp
-            sig.three_da = member.uid in three_da
-            sig.webmaster = member.uid in webmaster
-            sig.c_m = member.uid in c_m
-            sig.w_m = member.uid in w_m
-            sig.drink_admin = member.uid in drink
-            db.session.add(sig)
-
-        for frosh in Freshman.query.filter(Freshman.rit_username != freshman.rit_username).all():
-            db.session.add(FreshSignature(packet=packet, freshman=frosh))
+    upper_roles = _upper_roles()
+
+    # Create the new packets for each freshman in the given CSV
+    app.logger.info('Creating DB entries and queueing emails...')
+    all_freshmen = [username for username, in db.session.query(Freshman.rit_username)]
+    packets = [Packet(freshman=freshman, start=start, end=end,
+                      upper_required=len(upper_roles), fresh_required=len(all_freshmen) - 1)
+               for freshman in Freshman.query.filter(cast(Any, Freshman.rit_username).in_(freshmen_list)).all()]
+    db.session.add_all(packets)
+    db.session.flush()
+
+    # Bulk insert all of the signatures for the new packets
+    upper_rows = [{'packet_id': packet.id, 'member': uid, **roles}
+                  for packet in packets for uid, roles in upper_roles.items()]
+    fresh_rows = [{'packet_id': packet.id, 'freshman_username': username}
+                  for packet in packets for username in all_freshmen if username != packet.freshman_username]
+    _insert_in_batches(UpperSignature.__table__, upper_rows)
+    _insert_in_batches(FreshSignature.__table__, fresh_rows)
+
+    # The mail and notifications are sent by the worker once this commits
+    enqueue('packets_starting', start=start.isoformat())
+    enqueue('packet_start_mails', packet_ids=[packet.id for packet in packets])
+    for packet in packets:
+        enqueue('packet_starting', packet_id=packet.id)
 
     db.session.commit()
 
+    summary: PacketCreationSummary = {
+        'packets': len(packets),
+        'upper_signatures': len(upper_rows),
+        'fresh_signatures': len(fresh_rows),
+        'seconds': (datetime.now() - started).total_seconds(),
+    }
+    app.logger.info('Created {packets} packets with {upper_signatures} upper and {fresh_signatures} fresh signatures '
+                    'in {seconds} seconds'.format(**summary))
+    return summary
+
+
+class LDAPSyncSummary(TypedDict):
+    roles_updated: int
+    demoted: int
+    promoted: int
+    created: int
+    seconds: float
 
-def sync_with_ldap() -> None:
-    app.logger.info('Fetching data from LDAP...')
-    all_upper = {member.uid: member for member in filter(
-        lambda member: not ldap.is_intromember(member) and not ldap.is_on_coop(member), ldap.get_active_members())}
-
-    rtp = ldap.get_active_rtps()
-    three_da = ldap.get_3das()
-    webmaster = ldap.get_webmasters()
-    c_m = ldap.get_constitutional_maintainers()
-    w_m = ldap.get_wiki_maintainers()
-    drink = ldap.get_drink_admins()
-
-    app.logger.info('Applying updates to the DB...')
-    for packet in Packet.query.filter(Packet.end > datetime.now()).all():
-        # Update the role state of all UpperSignatures
-        for sig in filter(lambda sig: sig.member in all_upper, packet.upper_signatures):
-            sig.eboard = ldap.get_eboard_role(all_upper[sig.member])
-            sig.active_rtp = sig.member in rtp
-            sig.three_da = sig.member in three_da
-            sig.webmaster = sig.member in webmaster
-            sig.c_m = sig.member in c_m
-            sig.w_m = sig.member in w_m
-            sig.drink_admin = sig.member in drink
-
-        # Migrate UpperSignatures that are from accounts that are not active anymore
-        for sig in filter(lambda sig: sig.member not in all_upper, packet.upper_signatures):
-            UpperSignature.query.filter_by(packet_id=packet.id, member=sig.member).delete()
-            if sig.signed:
-                sig = MiscSignature(packet=packet, member=sig.member)
-                db.session.add(sig)
-
-        # Migrate MiscSignatures that are from accounts that are now active members
-        for sig in filter(lambda sig: sig.member in all_upper, packet.misc_signatures):
-            MiscSignature.query.filter_by(packet_id=packet.id, member=sig.member).delete()
-            sig = UpperSignature(packet=packet, member=sig.member, signed=True)
-            sig.eboard = ldap.get_eboard_role(all_upper[sig.member])
-            sig.active_rtp = sig.member in rtp
-            sig.three_da = sig.member in three_da
-            sig.webmaster = sig.member in webmaster
-            sig.c_m = sig.member in c_m
-            sig.w_m = sig.member in w_m
-            sig.drink_admin = sig.member in drink
-            db.session.add(sig)
-
-        # Create UpperSignatures for any new active members
-        # pylint: disable=cell-var-from-loop
-        upper_sigs = set(map(lambda sig: sig.member, packet.upper_signatures))
-        for member in filter(lambda member: member not in upper_sigs, all_upper):
-            sig = UpperSignature(packet=packet, member=member)
-            sig.eboard = ldap.get_eboard_role(all_upper[sig.member])
-            sig.active_rtp = sig.member in rtp
-            sig.three_da = sig.member in three_da
-            sig.webmaster = sig.member in webmaster
-            sig.c_m = sig.member in c_m
-            sig.w_m = sig.member in w_m
-            sig.drink_admin = sig.member in drink
-            db.session.add(sig)
 
+def sync_with_ldap() -> LDAPSyncSummary:
+    """
+    Brings the upperclassmen signatures of all open and future packets in line with LDAP
+    Only rows that actually differ are written, using one bulk statement per kind of change
+    :return: The number of rows changed of each kind and how long it took
+    """
+    started = datetime.now()
+    app.logger.info('Fetching data from LDAP...')
+    upper_roles = _upper_roles()
+    upper_table = UpperSignature.__table__
+    misc_table = MiscSignature.__table__
+    role_keys = ('eboard', 'active_rtp', 'three_da', 'webmaster', 'c_m', 'w_m', 'drink_admin')
+
+    app.logger.info('Comparing against the DB...')
+    packet_ids = [packet_id for packet_id, in db.session.query(Packet.id).filter(Packet.end > datetime.now())]
+    upcoming = select(Packet.id).where(Packet.end > datetime.now())
+    upper_sigs = db.session.query(upper_table.c.packet_id, upper_table.c.member, upper_table.c.signed,
+                                  upper_table.c.updated, *(upper_table.c[key] for key in role_keys)) \
+        .filter(upper_table.c.packet_id.in_(upcoming)) \
+        .all()
+    misc_sigs = db.session.query(misc_table.c.packet_id, misc_table.c.member, misc_table.c.updated) \
+        .filter(misc_table.c.packet_id.in_(upcoming)) \
+        .all()
+
+    # Update the role state of UpperSignatures whose roles changed, leaving `updated` alone so stats aren't affected
+    stale = [sig for sig in upper_sigs if sig.member in upper_roles and
+             {key: getattr(sig, key) for key in role_keys} != upper_roles[sig.member]]
+    stale_members = {sig.member for sig in stale}
+    if stale_members:
+        db.session.execute(
+            upper_table.update()
+            .where(upper_table.c.packet_id.in_(upcoming), upper_table.c.member == bindparam('uid'))
+            .values(updated=upper_table.c.updated,
+                    **{key: bindparam('new_' + key) for key in role_keys}),
+            [{'uid': uid, **{'new_' + key: value for key, value in upper_roles[uid].items()}}
+             for uid in stale_members])
+
+    # Migrate UpperSignatures that are from accounts that are not active anymore
+    demoted = [sig for sig in upper_sigs if sig.member not in upper_roles]
+    if demoted:
+        db.session.execute(upper_table.delete().where(upper_table.c.packet_id.in_(upcoming),
+                                                      upper_table.c.member.in_({sig.member for sig in demoted})))
+        _insert_in_batches(misc_table, [{'packet_id': sig.packet_id, 'member': sig.member, 'updated': sig.updated}
+                                        for sig in demoted if sig.signed])
+
+    # Migrate MiscSignatures that are from accounts that are now active members
+    promoted = [sig for sig in misc_sigs if sig.member in upper_roles]
+    if promoted:
+        db.session.execute(misc_table.delete().where(misc_table.c.packet_id.in_(upcoming),
+                                                     misc_table.c.member.in_({sig.member for sig in promoted})))
+        _insert_in_batches(upper_table, [{'packet_id': sig.packet_id, 'member': sig.member, 'signed': True,
+                                          'updated': sig.updated, **upper_roles[sig.member]} for sig in promoted])
+
+    # Create UpperSignatures for any new active members
+    existing = {(sig.packet_id, sig.member) for sig in chain(upper_sigs, promoted)}
+    created = [{'packet_id': packet_id, 'member': uid, **roles}
+               for packet_id in packet_ids for uid, roles in upper_roles.items() if (packet_id, uid) not in existing]
+    _insert_in_batches(upper_table, created)
+
+    # Recounting also bumps the revision of packets whose signatures were only given new roles
+    changed_packets = {sig.packet_id for sig in chain(stale, demoted, promoted)} | \
+        {row['packet_id'] for row in created}
+    if changed_packets:
+        Packet.recount_signatures(cast(Any, Packet.id).in_(changed_packets))
+        # Pages open on these packets get their new counts when the sync commits, like they do for a signature
+        for packet in Packet.query.filter(cast(Any, Packet.id).in_(changed_packets)):
+            publish(counts_event(packet.id, packet.signatures_received(), packet.signatures_required()))
     db.session.commit()
 
+    # Identities are resolved from the signatures as well as LDAP, so they're dropped once the new ones are committed
+    _resolve_identity.cache_clear()
+
+    summary: LDAPSyncSummary = {
+        'roles_updated': len(stale),
+        'demoted': len(demoted),
+        'promoted': len(promoted),
+        'created': len(created),
+        'seconds': (datetime.now() - started).total_seconds(),
+    }
+    app.logger.info('LDAP sync updated the roles of {roles_updated} signatures, demoted {demoted}, promoted '
+                    '{promoted}, and created {created} in {seconds} seconds'.format(**summary))
+    return summary
+
 
-@auth.oidc_auth('app')
 def is_frosh() -> bool:
     """
     Check if the current user is a freshman.
     """
     if app.config['REALM'] == 'csh':
-        username = str(session['userinfo'].get('preferred_username', ''))
-        return ldap.is_intromember(ldap.get_member(username))
+        return current_identity().is_frosh
     # Always true for the intro realm
     return True